@@ -0,0 +1,192 @@
+"""
+Autotuner which finds the fastest inference settings of this machine and writes them to its inference profile.
+
+The settings are swept on synthetic 257x257x3 volumes (see benchmark.py) in two stages:
+
+1. In one process, every backend is measured with every intra-op thread count and, where supported, the inter-op
+   thread counts of ONNX Runtime and the channels last memory format of pytorch, each with every batch size.
+2. The fastest setting is then run in 1, 2, 4, ... concurrent worker processes which share the cpus like the sharded
+   ingestion does, with the threads of every process reduced to its share of the cpus.
+
+The configuration with the highest total throughput is written to the inference profile (see inference_profile.py),
+which Model loads at startup. The ingestion program uses the number of processes of the profile if --workers is not
+given.
+
+Usage: python autotune.py [--backends torch onnx] [--threads 1 2 4] [--batch-sizes 1 4 8 16 32] [--processes 1 2 4]
+                          [--images 64] [--repeats 3] [--output inference_profile.json]
+"""
+
+import os
+import time
+import queue
+import argparse
+import multiprocessing
+import numpy as np
+from backends import BACKENDS
+from detect_single import Detector
+from benchmark import synthetic_volume
+from inference_profile import profile_path, save_profile, usable_cpus, PROFILE_FILE
+
+
+def powers_of_two(maximum):
+    """
+    1, 2, 4, ... up to maximum, and maximum itself
+    """
+    return sorted({2 ** exponent for exponent in range(maximum.bit_length()) if 2 ** exponent <= maximum} | {maximum})
+
+
+def synthetic_volumes(count, seed=0):
+    """
+    Synthetic microwave volumes, see benchmark.synthetic_volume
+    """
+    rng = np.random.default_rng(seed)
+    return [synthetic_volume(rng)[0] for _ in range(count)]
+
+
+def backend_settings(backend, threads, inter_op_threads):
+    """
+    Settings of a backend which are swept for one intra-op thread count
+    :param backend: name of the backend, see backends.BACKENDS
+    :param threads: number of intra-op threads
+    :param inter_op_threads: inter-op thread counts swept for ONNX Runtime
+    :return: list of keyword argument dictionaries of the backend
+    """
+    if backend.startswith('onnx'):
+        return [{'intra_op_threads': threads, 'inter_op_threads': inter} for inter in inter_op_threads]
+    return [{'intra_op_threads': threads, 'channels_last': channels_last} for channels_last in (False, True)]
+
+
+def throughput(detector, volumes, batch_size, repeats):
+    """
+    Best of repeats of Detector.detect_volumes in images per second
+    """
+    detector.detect_volumes(volumes[:batch_size], batch_size)  # warmup at this batch size
+    best = float('inf')
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        detector.detect_volumes(volumes, batch_size)
+        best = min(best, time.perf_counter() - tic)
+    return len(volumes) / best
+
+
+def sweep(volumes, config):
+    """
+    First stage: backends, thread counts, memory formats and batch sizes in this process.
+    :param volumes: synthetic volumes
+    :param config: parsed command line arguments
+    :return: list of result dictionaries with backend, backend_settings, batch_size and images_per_second
+    """
+    results = []
+    for backend in config.backends:
+        for threads in config.threads:
+            for settings in backend_settings(backend, threads, config.inter_op_threads):
+                try:
+                    detector = Detector(backend=BACKENDS[backend](**settings))
+                except (ImportError, FileNotFoundError) as error:  # e.g. onnxruntime or the int8 model is missing
+                    print(f"Skipping {backend}: {error}")
+                    break
+                for batch_size in config.batch_sizes:
+                    result = {'backend': backend, 'backend_settings': settings, 'batch_size': batch_size,
+                              'images_per_second': throughput(detector, volumes, batch_size, config.repeats)}
+                    print(f"{backend:12} {settings} batch {batch_size:4d}: {result['images_per_second']:8.1f} images/s")
+                    results.append(result)
+    return results
+
+
+def _process_worker(cpus, best, config, barrier, messages):
+    """
+    Run the best setting of the first stage in one of several concurrent processes
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    detector = Detector(backend=BACKENDS[best['backend']](**best['backend_settings']))
+    volumes = synthetic_volumes(config.images, config.seed)
+    detector.detect_volumes(volumes[:best['batch_size']], best['batch_size'])  # warmup
+
+    barrier.wait()
+    start = time.time()
+    for _ in range(config.repeats):
+        detector.detect_volumes(volumes, best['batch_size'])
+    messages.put((start, time.time(), len(volumes) * config.repeats))
+
+
+def _collect(workers, messages):
+    """
+    Wait for the worker processes and compute their total throughput from the first start to the last end
+    """
+    timings = []
+    while len(timings) < len(workers):
+        try:
+            timings.append(messages.get(timeout=1))
+        except queue.Empty:
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                raise RuntimeError('An autotune worker process failed') from None
+    for worker in workers:
+        worker.join()
+    starts, ends, counts = zip(*timings)
+    return sum(counts) / (max(ends) - min(starts))
+
+
+def sweep_processes(best, config):
+    """
+    Second stage: the best setting of the first stage in concurrent worker processes.
+    :param best: fastest result of the first stage
+    :param config: parsed command line arguments
+    :return: list of result dictionaries with the number of processes and the total images_per_second
+    """
+    context = multiprocessing.get_context('spawn')
+    all_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    results = []
+    for processes in config.processes:
+        barrier = context.Barrier(processes)
+        messages = context.Queue()
+        threads = min(best['backend_settings']['intra_op_threads'], max(1, len(all_cpus) // processes))
+        settings = {**best['backend_settings'], 'intra_op_threads': threads}
+        workers = [context.Process(target=_process_worker, daemon=True,
+                                   args=(all_cpus[index::processes] or all_cpus,
+                                         {**best, 'backend_settings': settings}, config, barrier, messages))
+                   for index in range(processes)]
+        for worker in workers:
+            worker.start()
+        result = {**best, 'backend_settings': settings, 'processes': processes,
+                  'images_per_second': _collect(workers, messages)}
+        print(f"{processes:3d} processes, {settings}: {result['images_per_second']:8.1f} images/s")
+        results.append(result)
+    return results
+
+
+def main():
+    """
+    Command line interface
+    """
+    cpus = usable_cpus()
+    parser = argparse.ArgumentParser(description='Find the fastest inference settings of this machine')
+    parser.add_argument('--backends', nargs='+', default=['torch', 'onnx'], choices=sorted(BACKENDS))
+    parser.add_argument('--threads', nargs='+', type=int, default=powers_of_two(cpus), help='intra-op threads')
+    parser.add_argument('--inter-op-threads', nargs='+', type=int, default=[1, 2],
+                        help='inter-op threads of ONNX Runtime')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 8, 16, 32])
+    parser.add_argument('--processes', nargs='+', type=int, default=powers_of_two(cpus),
+                        help='numbers of concurrent worker processes')
+    parser.add_argument('--images', type=int, default=64, help='number of synthetic volumes per measurement')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=str(profile_path() or PROFILE_FILE), help='path of the profile')
+    config = parser.parse_args()
+
+    results = sweep(synthetic_volumes(config.images, config.seed), config)
+    if not results:
+        raise RuntimeError('None of the backends could be loaded')
+    best = max(results, key=lambda result: result['images_per_second'])
+    print(f"Fastest in one process: {best['backend']} {best['backend_settings']} batch {best['batch_size']:d}")
+
+    # the processes are compared with each other, the first stage measured the best of repeats instead
+    best = max(sweep_processes(best, config) or [{**best, 'processes': 1}],
+               key=lambda result: result['images_per_second'])
+    path = save_profile(best, config.output)
+    print(f"Profile written to {path}: {best['backend']} {best['backend_settings']} batch {best['batch_size']:d}, "
+          f"{best['processes']:d} processes, {best['images_per_second']:.1f} images/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""
+Inference backends of the detector.
+
+A backend loads the weights and returns a model which is called with a normalized BxCxHxW tensor and returns the raw
+yolov5 predictions, exactly like DetectMultiBackend does.
+
+Modules which are only needed by some backends (the yolov5 model definitions, onnx and onnxruntime) are imported when
+they are first used, such that e.g. loading a cached TorchScript model does not pay for them.
+"""
+import os
+import json
+import importlib
+from functools import partial
+from pathlib import Path
+from torch import channels_last as CHANNELS_LAST, cuda, from_numpy, jit, set_num_threads, zeros
+from torch import device as torch_device
+from torch import onnx as torch_onnx
+from yolo_utils import check_img_size
+
+
+def default_device():
+    """
+    The first CUDA device if CUDA is available, the CPU otherwise
+    """
+    return '0' if cuda.is_available() else 'cpu'
+
+
+def select_device(device):
+    """
+    Torch device of a device string like yolov5's select_device
+    :param device: 'cpu' or cuda devices, i.e. 0 or 0,1,2,3 of which the first one is used
+    """
+    device = str(device).strip().lower().replace('cuda:', '')
+    return torch_device('cpu' if device == 'cpu' else f"cuda:{device.split(',', maxsplit=1)[0]}")
+
+
+def artifact_file(weights, img_size, extension, tag=''):
+    """
+    Path of a model artifact which is derived from the weights and cached next to them
+    :param weights: path of the pytorch weights
+    :param img_size: inference size (height, width)
+    :param extension: file extension of the artifact, e.g. '.onnx'
+    :param tag: optional tag distinguishing artifacts of the same kind, e.g. the precision
+    :return: Path
+    """
+    weights = Path(weights)
+    suffix = f'_{tag}' if tag else ''
+    return weights.with_name(f'{weights.stem}_{img_size[0]}x{img_size[1]}{suffix}{extension}')
+
+
+def is_outdated(artifact, weights):
+    """
+    Whether a cached artifact is missing or older than the weights it has been derived from
+    """
+    return not artifact.exists() or artifact.stat().st_mtime < Path(weights).stat().st_mtime
+
+
+def load_weights(weights, data, device):
+    """
+    Load and fuse the pytorch weights with DetectMultiBackend
+    """
+    common = importlib.import_module('yolov5.models.common')
+    return common.DetectMultiBackend(weights, device=device, dnn=False, data=data, fp16=False)
+
+
+def export_torchscript(model, script_file, img_size):
+    """
+    Trace a fused pytorch model at a fixed input size and serialize it with TorchScript.
+    :param model: yolov5 pytorch model
+    :param script_file: path of the serialized model
+    :param img_size: inference size (height, width)
+    """
+    model = model.float().eval()
+    img = zeros(1, 3, *img_size, device=next(model.parameters()).device)
+    tmp_file = Path(f'{script_file}.tmp')
+    config = {'stride': int(max(model.stride)), 'names': model.names}
+    jit.save(jit.trace(model, img, strict=False), str(tmp_file), _extra_files={'config.txt': json.dumps(config)})
+    os.replace(tmp_file, script_file)
+
+
+def export_onnx(model, onnx_file, img_size, opset=12):
+    """
+    Export a pytorch model to ONNX with a fixed input size and a dynamic batch dimension.
+    :param model: yolov5 pytorch model
+    :param onnx_file: path of the exported model
+    :param img_size: inference size (height, width)
+    :param opset: ONNX opset version
+    """
+    model = model.float().cpu().eval()
+    tmp_file = Path(f'{onnx_file}.tmp')
+    torch_onnx.export(model, zeros(1, 3, *img_size), str(tmp_file), opset_version=opset, do_constant_folding=True,
+                      input_names=['images'], output_names=['output'],
+                      dynamic_axes={'images': {0: 'batch'}, 'output': {0: 'batch'}})
+
+    # store stride and class names such that the exported model can be used without the pytorch weights
+    onnx = importlib.import_module('onnx')
+    model_onnx = onnx.load(str(tmp_file))
+    for key, value in {'stride': int(max(model.stride)), 'names': model.names}.items():
+        meta = model_onnx.metadata_props.add()
+        meta.key, meta.value = key, str(value)
+    onnx.save(model_onnx, str(tmp_file))
+    os.replace(tmp_file, onnx_file)
+
+
+class OnnxModel:
+    """
+    ONNX Runtime CPU session which can be used in place of DetectMultiBackend
+    """
+
+    fp16 = False
+
+    def __init__(self, onnx_file, intra_op_threads=0, inter_op_threads=0):
+        onnxruntime = importlib.import_module('onnxruntime')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads  # 0 lets ONNX Runtime choose
+        options.inter_op_num_threads = inter_op_threads
+        self.session = onnxruntime.InferenceSession(str(onnx_file), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        self.stride = int(self.session.get_modelmeta().custom_metadata_map['stride'])
+
+    def __call__(self, img, augment=False, visualize=False):
+        """
+        Run inference on a normalized BxCxHxW tensor
+        """
+        del augment, visualize  # not supported by exported models
+        return from_numpy(self.session.run([self.output_name], {self.input_name: img.cpu().numpy()})[0])
+
+    def warmup(self, imgsz=(1, 3, 640, 640)):
+        """
+        Run a single inference with an empty image
+        """
+        self(zeros(*imgsz))
+
+
+class TorchScriptModel:
+    """
+    Pre-fused TorchScript model which can be used in place of DetectMultiBackend
+    """
+
+    fp16 = False
+
+    def __init__(self, script_file, device):
+        extra_files = {'config.txt': ''}
+        self.model = jit.load(str(script_file), _extra_files=extra_files, map_location=device)
+        self.device = device
+        self.stride = json.loads(extra_files['config.txt'])['stride']
+
+    def __call__(self, img, augment=False, visualize=False):
+        """
+        Run inference on a normalized BxCxHxW tensor
+        """
+        del augment, visualize  # not supported by traced models
+        return self.model(img)[0]
+
+    def warmup(self, imgsz=(1, 3, 640, 640)):
+        """
+        Run a single inference with an empty image
+        """
+        self(zeros(*imgsz, device=self.device))
+
+
+class Backend:
+    """
+    Base class of the inference backends
+    """
+
+    name = ''
+
+    def describe(self):
+        """
+        Name and settings of the backend, e.g. for metrics and fingerprints
+        :return: dictionary with the name and the public attributes of the backend
+        """
+        return {'backend': self.name, **{key: str(value) for key, value in vars(self).items()}}
+
+    def load(self, weights, data, img_size):
+        """
+        Load the weights.
+        :param weights: path of the pytorch weights
+        :param data: path of the dataset yaml file
+        :param img_size: inference size (height, width)
+        :return: model which can be used in place of DetectMultiBackend
+        """
+        raise NotImplementedError
+
+
+class TorchBackend(Backend):
+    """
+    Eager pytorch inference of the weights with DetectMultiBackend
+    """
+
+    name = 'torch'
+
+    def __init__(self, device=None, intra_op_threads=0, channels_last=False):
+        """
+        :param device: cuda device, i.e. 0 or 0,1,2,3 or cpu (default: first CUDA device if available, else cpu)
+        :param intra_op_threads: number of pytorch threads, 0 keeps the pytorch default
+        :param channels_last: convert the weights into the channels last memory format, which the convolutions then
+                              also use for their inputs and outputs
+        """
+        self.device = select_device(default_device() if device is None else device)
+        self.intra_op_threads = intra_op_threads
+        self.channels_last = channels_last
+
+    def load(self, weights, data, img_size):
+        """
+        Load the weights.
+        :param weights: path of the pytorch weights
+        :param data: path of the dataset yaml file
+        :param img_size: inference size (height, width)
+        :return: DetectMultiBackend
+        """
+        del img_size  # pytorch models accept any input size which is a multiple of the stride
+        if self.intra_op_threads:
+            set_num_threads(self.intra_op_threads)
+        model = load_weights(weights, data, self.device)
+        if self.channels_last:
+            model.model.to(memory_format=CHANNELS_LAST)
+        return model
+
+
+class TorchScriptBackend(TorchBackend):
+    """
+    Pytorch inference of a pre-fused TorchScript model. The fused weights are traced once at the fixed input size and
+    cached next to the weights, such that later runs neither import the yolov5 model definitions nor rebuild and fuse
+    the network from the weights.
+    """
+
+    name = 'torchscript'
+
+    def load(self, weights, data, img_size):
+        """
+        Load the cached TorchScript model and trace it first if it is missing or outdated.
+        :param weights: path of the pytorch weights
+        :param data: path of the dataset yaml file
+        :param img_size: inference size (height, width)
+        :return: TorchScriptModel
+        """
+        if self.intra_op_threads:
+            set_num_threads(self.intra_op_threads)
+
+        script_file = artifact_file(weights, img_size, '.torchscript', self.device.type)
+        if is_outdated(script_file, weights):
+            model = load_weights(weights, data, self.device)
+            export_torchscript(model.model, script_file, check_img_size(img_size, s=model.stride))
+
+        model = TorchScriptModel(script_file, self.device)
+        if self.channels_last:
+            model.model.to(memory_format=CHANNELS_LAST)
+        return model
+
+
+class OnnxBackend(Backend):
+    """
+    ONNX Runtime inference on the CPU. The weights are exported once to an ONNX model with a fixed input size and a
+    dynamic batch dimension, which is cached next to the weights and reused as long as it is newer than the weights.
+
+    With precision='int8' the quantized model built and validated by quantization.py is used instead.
+    """
+
+    name = 'onnx'
+
+    def __init__(self, intra_op_threads=0, inter_op_threads=0, precision='fp32'):
+        """
+        :param intra_op_threads: number of threads used within an operator, 0 lets ONNX Runtime choose
+        :param inter_op_threads: number of threads used to run operators in parallel, 0 lets ONNX Runtime choose
+        :param precision: 'fp32' for the exported model or 'int8' for the quantized model
+        """
+        self.device = select_device('cpu')
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.precision = precision
+
+    @staticmethod
+    def onnx_file(weights, img_size, precision='fp32'):
+        """
+        Path of the cached ONNX model for the given weights, inference size and precision
+        """
+        return artifact_file(weights, img_size, '.onnx', '' if precision == 'fp32' else precision)
+
+    def load(self, weights, data, img_size):
+        """
+        Load the cached ONNX model and export it first if it is missing or outdated.
+        :param weights: path of the pytorch weights
+        :param data: path of the dataset yaml file
+        :param img_size: inference size (height, width)
+        :return: OnnxModel
+        """
+        onnx_file = self.onnx_file(weights, img_size, self.precision)
+        outdated = is_outdated(onnx_file, weights)
+        if outdated and self.precision != 'fp32':
+            raise FileNotFoundError(f"{onnx_file} is missing or older than {weights}, build it with "
+                                    f"'python quantization.py <calibration_dir>'")
+        if outdated:
+            model = load_weights(weights, data, self.device)
+            export_onnx(model.model, onnx_file, check_img_size(img_size, s=model.stride))
+
+        return OnnxModel(onnx_file, self.intra_op_threads, self.inter_op_threads)
+
+
+BACKENDS = {
+    'torch': TorchBackend,
+    'torchscript': TorchScriptBackend,
+    'onnx': OnnxBackend,
+    'onnx-int8': partial(OnnxBackend, precision='int8'),
+}
@@ -0,0 +1,208 @@
+"""
+Reproducible throughput benchmark of the prediction pipeline on synthetic microwave volumes.
+
+Synthetic 257x257x3 linear scale volumes with a blister lattice of present and missing pills are generated from a fixed
+seed. Model.predict (reading, preprocessing, inference and formatting) and Detector.detect_volumes (in-memory inference
+only) are measured for every combination of backend, thread count, batch size and dataset size. The results are
+written to a JSON file and can be compared against a stored baseline with a maximum allowed throughput regression.
+
+Usage: python benchmark.py [--backends torch onnx] [--threads 1 4] [--batch-sizes 1 16] [--sizes 256]
+                           [--output benchmark.json] [--baseline baseline.json --max-regression 0.1]
+"""
+
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+from timeit import default_timer
+import numpy as np
+import skimage.io
+import torch
+from backends import BACKENDS
+from model import Model
+
+VOLUME_SHAPE = (257, 257, 3)
+
+
+def synthetic_volume(rng, rows=4, columns=5, missing_rate=0.1):
+    """
+    Generate a linear scale microwave volume with a lattice of pills and its label.
+    :param rng: numpy random generator
+    :param rows: number of blister rows
+    :param columns: number of blister columns
+    :param missing_rate: probability of an empty blister
+    :return: float32 volume with shape 257x257x3 and the label dictionary
+    """
+    height, width, _ = VOLUME_SHAPE
+    y_grid, x_grid = np.mgrid[0:height, 0:width]
+    centers = np.stack(np.meshgrid(np.linspace(width * 0.15, width * 0.85, columns) + rng.normal(0, 2, columns),
+                                   np.linspace(height * 0.15, height * 0.85, rows) + rng.normal(0, 2, rows)),
+                       axis=-1).reshape(-1, 2)
+    missing = rng.random(len(centers)) < missing_rate
+    amplitudes = rng.uniform(0.8, 1.2, len(centers)) * np.where(missing, 1.0, 3.0)  # empty blisters reflect less
+
+    volume = rng.gamma(2.0, 0.05, VOLUME_SHAPE).astype(np.float32)  # speckle background
+    for center, amplitude in zip(centers, amplitudes):
+        volume += (amplitude * np.exp(-((x_grid - center[0]) / 10) ** 2 - ((y_grid - center[1]) / 7) ** 2)[..., None]
+                   * rng.uniform(0.7, 1.0, VOLUME_SHAPE[2])).astype(np.float32)
+
+    # labels count y from the bottom of the image
+    coordinates = {pill_type: [(float(x), float(height - y)) for x, y in centers[mask]]
+                   for pill_type, mask in (('missing', missing), ('present', ~missing))}
+    return volume, {'missing_pills': len(coordinates['missing']), 'present_pills': len(coordinates['present']),
+                    'coordinates': coordinates}
+
+
+def generate_dataset(directory, size, seed=0):
+    """
+    Write synthetic tiff volumes and their json labels into a directory.
+    :param directory: output directory
+    :param size: number of volumes
+    :param seed: seed of the random generator
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for index in range(size):
+        volume, label = synthetic_volume(rng)
+        name = f'synthetic_{index:06d}'
+        skimage.io.imsave(os.path.join(directory, f'{name}.tiff'), volume, check_contrast=False)
+        with open(os.path.join(directory, f'{name}.json'), 'w', encoding='utf-8') as file:
+            json.dump(label, file)
+
+
+def _tiff_files(directory):
+    """
+    Sorted paths of the tiff files in a directory, empty if it does not exist
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.tiff')]
+
+
+def _measure(model, directory, volumes, repeats):
+    """
+    Best of repeats for Model.predict over a directory and Detector.detect_volumes over in-memory volumes
+    """
+    result = {'predict_seconds': float('inf'), 'detect_seconds': float('inf')}
+    for _ in range(repeats):
+        model.timer.reset()
+        tic = default_timer()
+        model.predict(directory)
+        result['predict_seconds'] = min(result['predict_seconds'], default_timer() - tic)
+
+        tic = default_timer()
+        model.model.detect_volumes(volumes, model.batch_size)
+        result['detect_seconds'] = min(result['detect_seconds'], default_timer() - tic)
+
+    result['predict_images_per_second'] = len(volumes) / result['predict_seconds']
+    result['detect_images_per_second'] = len(volumes) / result['detect_seconds']
+    result['stages'] = model.timer.summary()
+    return result
+
+
+def run(data_dir, config):
+    """
+    Run the benchmark matrix.
+    :param data_dir: directory for the synthetic datasets, one subdirectory per size
+    :param config: parsed command line arguments with backends, threads, batch_sizes, sizes and repeats
+    :return: list with one result dictionary per combination
+    """
+    datasets = {}
+    for size in config.sizes:
+        directory = os.path.join(data_dir, f'synthetic_{size}_seed{config.seed}')
+        if len(_tiff_files(directory)) != size:
+            generate_dataset(directory, size, config.seed)
+        datasets[size] = directory
+
+    results = []
+    for backend in config.backends:
+        for threads in config.threads:
+            model = Model(backend=BACKENDS[backend](intra_op_threads=threads))
+            for size, directory in datasets.items():
+                volumes = [Model.load_microwave_volume(file_path) for file_path in _tiff_files(directory)]
+                for batch_size in config.batch_sizes:
+                    model.batch_size = batch_size
+                    model.prefetch = max(model.prefetch, batch_size)
+                    result = {'backend': backend, 'threads': threads, 'batch_size': batch_size, 'images': size,
+                              'startup': model.startup, **_measure(model, directory, volumes, config.repeats)}
+                    print(f"{backend:12} threads {threads:3d} batch {batch_size:4d} images {size:6d}: "
+                          f"predict {result['predict_images_per_second']:8.1f} images/s, "
+                          f"detect {result['detect_images_per_second']:8.1f} images/s")
+                    results.append(result)
+    return results
+
+
+def regressions(results, baseline, max_regression):
+    """
+    Compare the throughput against a baseline.
+    :param results: benchmark results
+    :param baseline: results of a previous run
+    :param max_regression: maximum allowed relative throughput loss, e.g. 0.1 for 10 %
+    :return: list of messages describing every combination which got slower than allowed
+    """
+    def key(result):
+        return result['backend'], result['threads'], result['batch_size'], result['images']
+
+    reference = {key(result): result for result in baseline}
+    messages = []
+    for result in results:
+        if key(result) not in reference:
+            continue
+        for metric in ('predict_images_per_second', 'detect_images_per_second'):
+            limit = (1 - max_regression) * reference[key(result)][metric]
+            if result[metric] < limit:
+                messages.append(f"{key(result)} {metric}: {result[metric]:.1f} < {limit:.1f} "
+                                f"(baseline {reference[key(result)][metric]:.1f})")
+    return messages
+
+
+def main():
+    """
+    Command line interface
+    """
+    parser = argparse.ArgumentParser(description='Throughput benchmark on synthetic microwave volumes')
+    parser.add_argument('--backends', nargs='+', default=['torch'], choices=sorted(BACKENDS))
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 16, 32])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[256], help='number of synthetic volumes')
+    parser.add_argument('--repeats', type=int, default=3, help='the best of the repeats is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='keep the synthetic datasets in this directory (default: temporary)')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='results of a previous run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='maximum allowed relative throughput loss against the baseline (default: 0.1)')
+    config = parser.parse_args()
+
+    baseline = None
+    if config.baseline:
+        if os.path.realpath(config.baseline) == os.path.realpath(config.output):
+            parser.error('--output must not overwrite the --baseline results')
+        with open(config.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run(config.data_dir or tmp_dir, config)
+
+    report = {
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+                    'python': platform.python_version(), 'torch': torch.__version__},
+        'results': results,
+    }
+    with open(config.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {config.output}")
+
+    if baseline is not None:
+        messages = regressions(results, baseline, config.max_regression)
+        for message in messages:
+            print(f"Regression: {message}")
+        if messages:
+            sys.exit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
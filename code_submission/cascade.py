@@ -0,0 +1,242 @@
+"""
+Classical pre-screen which answers routine blister images without the detector.
+
+The volume is converted into the same dB scale as Model.visualize_microwave_volume (20 log10 of every slice, limited to
+a dynamic range below the maximum of the slice), normalized and averaged over the slices. Present pills reflect
+strongly and show up as bright blobs. The blobs above the calibrated pill threshold are clustered into the rows and
+columns of the known blister lattice, and the intensity at every lattice slot separates present pills from empty
+blisters. The confidence combines the regularity of the fitted lattice with the margin of every slot to the threshold.
+Images whose confidence is below min_confidence are escalated to the detector.
+
+The lattice (rows and columns) and the threshold are calibrated on labelled volumes:
+
+Usage: python cascade.py calibrate <labelled_dir> [--output cascade.json]
+       python cascade.py evaluate <labelled_dir> [--cascade cascade.json] [--min-confidence 0.9]
+"""
+
+import os
+import json
+import glob
+import argparse
+import importlib
+from collections import Counter
+from timeit import default_timer
+import numpy as np
+import cv2
+from detect_single import DETECTION_DTYPE, ROOT
+from preprocessing import DYNAMIC_RANGE, db_slices
+
+SMOOTHING = 2.0  # standard deviation of the gaussian blur in pixels
+MIN_GAP = 10  # minimum distance in pixels between neighbouring lattice rows or columns
+SLOT_WINDOW = 7  # edge length in pixels of the window around a lattice slot in which its intensity is measured
+DEFAULT_FILE = ROOT / 'cascade.json'
+
+
+def db_image(volume, dynamic_range=DYNAMIC_RANGE):
+    """
+    Mean of the slices of a linear microwave volume in dB, normalized to [0, 1] over the dynamic range of each slice
+    :param volume: microwave volume with shape MxNx3
+    :param dynamic_range: dynamic range in dB
+    :return: float32 image with shape MxN
+    """
+    slices = db_slices(volume, dynamic_range)
+    return cv2.transform(slices, np.full((1, slices.shape[2]), 1 / slices.shape[2]))
+
+
+def _slot_image(image):
+    """
+    Maximum of the smoothed dB image within the slot window around every pixel
+    """
+    return cv2.dilate(image, np.ones((SLOT_WINDOW, SLOT_WINDOW), np.uint8))
+
+
+def _lattice(points, height):
+    """
+    Number of rows and columns of the labelled pill coordinates of one volume
+    """
+    points = np.array(points).reshape(-1, 2)
+    return tuple(len(np.split(axis, np.nonzero(np.diff(axis) >= MIN_GAP)[0] + 1))
+                 for axis in (np.sort(height - points[:, 1]), np.sort(points[:, 0])))
+
+
+def clusters(values, count):
+    """
+    Split one dimensional positions into count groups at the largest gaps.
+    :param values: positions
+    :param count: number of groups
+    :return: centers and standard deviations of the groups, or None if there are fewer than count separated groups
+    """
+    values = np.sort(values)
+    if len(values) < count:
+        return None
+    splits = np.sort(np.argsort(np.diff(values))[len(values) - count:]) + 1 if count > 1 else []
+    groups = np.split(values, splits)
+    if count > 1 and np.diff(values)[splits - 1].min() < MIN_GAP:
+        return None
+    return np.array([group.mean() for group in groups]), np.array([group.std() for group in groups])
+
+
+class PreScreen:
+    """
+    Classical pill counter on a known blister lattice with a confidence score
+    """
+
+    def __init__(self, lattice, threshold, margin, min_confidence=0.9):
+        """
+        :param lattice: (rows, columns) of the blister lattice
+        :param threshold: normalized dB intensity which separates present pills (above) from empty blisters
+        :param margin: intensity distance from the threshold at which a slot is classified with full confidence
+        :param min_confidence: images with a lower confidence are escalated to the detector
+        """
+        self.lattice = tuple(lattice)
+        self.threshold = threshold
+        self.margin = margin
+        self.min_confidence = min_confidence
+        self.counts = {'screened': 0, 'escalated': 0}
+
+    def screen(self, volume):
+        """
+        Count the pills of a volume on the blister lattice.
+        :param volume: microwave volume with shape MxNx3
+        :return: structured array of pills (see detect_single.DETECTION_DTYPE) and the confidence between 0 and 1
+        """
+        image = cv2.GaussianBlur(db_image(volume), (0, 0), SMOOTHING)
+        peaks = (image == cv2.dilate(image, np.ones((MIN_GAP, MIN_GAP), np.uint8))) & (image > self.threshold)
+        rows, columns = np.nonzero(peaks)
+        row_fit, column_fit = clusters(rows, self.lattice[0]), clusters(columns, self.lattice[1])
+        if row_fit is None or column_fit is None:
+            return np.empty(0, dtype=DETECTION_DTYPE), 0.0
+
+        # the lattice is regular if the blobs of a row or column are aligned and no slot holds two blobs
+        spacing = min(np.diff(row_fit[0]).min(initial=MIN_GAP * 2), np.diff(column_fit[0]).min(initial=MIN_GAP * 2))
+        regular = max(row_fit[1].max(), column_fit[1].max()) < spacing / 4 and len(rows) <= np.prod(self.lattice)
+
+        slot_rows, slot_columns = np.meshgrid(row_fit[0], column_fit[0], indexing='ij')
+        values = _slot_image(image)[np.rint(slot_rows).astype(int), np.rint(slot_columns).astype(int)].ravel()
+        confidence = float(np.clip(np.abs(values - self.threshold) / self.margin, 0, 1).min()) if regular else 0.0
+
+        pills = np.zeros(values.size, dtype=DETECTION_DTYPE)
+        pills['cls'] = values > self.threshold
+        pills['x'] = slot_columns.ravel()
+        pills['y'] = volume.shape[0] - slot_rows.ravel()
+        pills['conf'] = confidence
+        return pills, confidence
+
+    def detect(self, volume):
+        """
+        Pills of a volume if the pre-screen is confident, otherwise None to escalate it to the detector
+        :param volume: microwave volume with shape MxNx3
+        """
+        pills, confidence = self.screen(volume)
+        self.counts['screened'] += 1
+        if confidence < self.min_confidence:
+            self.counts['escalated'] += 1
+            return None
+        return pills
+
+    def stats(self):
+        """
+        Number of screened and escalated images and the escalated fraction
+        """
+        fraction = self.counts['escalated'] / self.counts['screened'] if self.counts['screened'] else 0.0
+        return {**self.counts, 'escalated_fraction': fraction}
+
+    def save(self, path):
+        """
+        Write the calibration to a json file
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'lattice': self.lattice, 'threshold': self.threshold, 'margin': self.margin,
+                       'min_confidence': self.min_confidence}, file, indent=2)
+
+    @classmethod
+    def load(cls, path, min_confidence=None):
+        """
+        Read a calibration written by save
+        :param path: path of the json file
+        :param min_confidence: overrides the stored minimum confidence
+        """
+        with open(path, 'r', encoding='utf-8') as file:
+            config = json.load(file)
+        if min_confidence is not None:
+            config['min_confidence'] = min_confidence
+        return cls(**config)
+
+
+def calibrate(data_set_directory, min_confidence=0.9):
+    """
+    Calibrate the lattice and the threshold on labelled volumes.
+    :param data_set_directory: directory with tiff files and their json labels
+    :param min_confidence: minimum confidence of the calibrated pre-screen
+    :return: PreScreen
+    """
+    model = importlib.import_module('model').Model  # the volumes are read like in Model.predict
+    lattices = Counter()
+    values = {'present': [], 'missing': []}
+    for file_path in sorted(glob.glob(os.path.join(data_set_directory, '*.tiff'))):
+        with open(os.path.splitext(file_path)[0] + '.json', 'r', encoding='utf-8') as file:
+            label = json.load(file)
+        volume = model.load_microwave_volume(file_path)
+        image = _slot_image(cv2.GaussianBlur(db_image(volume), (0, 0), SMOOTHING))
+
+        lattices[_lattice(label['coordinates']['present'] + label['coordinates']['missing'], volume.shape[0])] += 1
+        for pill_type, pill_values in values.items():
+            # pills labelled on the border of the volume are read at the nearest pixel
+            pill_values.extend(image[min(max(int(round(volume.shape[0] - y)), 0), image.shape[0] - 1),
+                                     min(max(int(round(x)), 0), image.shape[1] - 1)]
+                               for x, y in label['coordinates'][pill_type])
+
+    # the threshold lies in the middle of the gap between the bulk of both classes, the dB image is within [0, 1]
+    present, missing = np.percentile(values['present'] or [1], 5), np.percentile(values['missing'] or [0], 95)
+    return PreScreen(lattices.most_common(1)[0][0], float((present + missing) / 2),
+                     float(max(abs(present - missing) / 2, 1e-3)), min_confidence)
+
+
+def report(data_set_directory, prescreen):
+    """
+    Compare the model with and without the pre-screen on labelled volumes.
+    :param data_set_directory: directory with tiff files and their json labels
+    :param prescreen: calibrated PreScreen
+    :return: dictionary with the metrics and the prediction time of both and the escalated fraction
+    """
+    evaluation = importlib.import_module('evaluation')
+    model = importlib.import_module('model').Model()
+    result = {}
+    for name in ('detector', 'cascade'):
+        if name == 'cascade':
+            model.use_cascade(prescreen)
+        tic = default_timer()
+        result[name] = evaluation.evaluate(model, data_set_directory)
+        result[name]['prediction_time'] = default_timer() - tic
+    result['prescreen'] = prescreen.stats()
+    return result
+
+
+def main():
+    """
+    Command line interface
+    """
+    parser = argparse.ArgumentParser(description='Calibrate and evaluate the classical pre-screen')
+    parser.add_argument('command', choices=('calibrate', 'evaluate'))
+    parser.add_argument('data_set_directory', help='directory with labelled tiff files')
+    parser.add_argument('--cascade', default=str(DEFAULT_FILE), help='calibration file')
+    parser.add_argument('--output', default=str(DEFAULT_FILE), help='calibration file written by calibrate')
+    parser.add_argument('--min-confidence', type=float, help='escalate images below this confidence (default: 0.9)')
+    config = parser.parse_args()
+
+    if config.command == 'calibrate':
+        prescreen = calibrate(config.data_set_directory, config.min_confidence or 0.9)
+        prescreen.save(config.output)
+        print(f"Lattice {prescreen.lattice}, threshold {prescreen.threshold:.3f}, margin {prescreen.margin:.3f} "
+              f"written to {config.output}")
+        return
+
+    result = report(config.data_set_directory, PreScreen.load(config.cascade, config.min_confidence))
+    for metric in result['detector']:
+        print(f"{metric:26}: detector {result['detector'][metric]:>10.4f}  cascade {result['cascade'][metric]:>10.4f}")
+    print(f"Escalated {result['prescreen']['escalated']:d} of {result['prescreen']['screened']:d} images "
+          f"({100 * result['prescreen']['escalated_fraction']:.1f} %) to the detector")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,41 +4,196 @@ Team-motto:   Memelords know better
 Team-members: Florian Eder
               Moritz Enderle
               John Tran
+
+
+Build the yolov5 training set from labelled microwave volumes.
+
+Every labelled tiff file is converted into a gray png with preprocessing.gray_image, the same conversion and intensity
+scale as inference, and its json label into a yolov5 label file. Files are assigned to the train or validation split
+by a hash of their name, so the split of a file never changes when scans are added. The build is incremental: a file
+is only converted again if its tiff or json file, the intensity scale or its split have changed since the last build,
+and the conversions run in a process pool. The output directory contains
+
+    images/{train,val}/<name>.png, labels/{train,val}/<name>.txt   yolov5 layout
+    train.txt, val.txt                                              split manifests with the image paths
+    dataset.yaml                                                    data file for yolov5 train.py
+    build.json                                                      state of the last build
+
+Usage: python competition_create_images.py [source] [--output dir] [--val-fraction 0.1] [--workers N] [--scale 50]
+
+To train the model, download the yolov5 github repo and run the following command:
+python3 train.py --data <output>/dataset.yaml --img-size 256 --batch-size 16 --nosave --epochs 1000
+    --weights yolov5n.pt --cfg yolov5n.yaml --device 0
 """
 
-import json
 import os
+import json
+import glob
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import skimage.io
 import cv2
+from preprocessing import INTENSITY_SCALE, gray_image
+
+STATE_FILE = 'build.json'
+SPLITS = ('train', 'val')
+PILL_SIZE = (30, 20)  # width and height of the yolov5 boxes in pixels
+CLASS_NAMES = ['missing', 'present']
+
+
+def split_of(name, val_fraction):
+    """
+    Split of a file, stable for a given name and validation fraction
+    :param name: file name of the tiff file
+    :param val_fraction: fraction of the files in the validation split
+    :return: 'train' or 'val'
+    """
+    return 'val' if zlib.crc32(name.encode()) / 2 ** 32 < val_fraction else 'train'
+
+
+def _source_state(file_path):
+    """
+    Size and modification time of the tiff file and of its json label
+    """
+    return [[stat.st_size, stat.st_mtime_ns] for stat in map(os.stat, (file_path, _label_file(file_path)))]
+
+
+def _label_file(file_path):
+    return os.path.splitext(file_path)[0] + '.json'
+
+
+def _outputs(output_directory, name, split):
+    """
+    Paths of the png image and of the yolov5 label file of a tiff file
+    """
+    stem = os.path.splitext(name)[0]
+    return (os.path.join(output_directory, 'images', split, f'{stem}.png'),
+            os.path.join(output_directory, 'labels', split, f'{stem}.txt'))
+
+
+def convert(file_path, image_file, label_file, scale=INTENSITY_SCALE):
+    """
+    Convert one labelled tiff file into a gray png and a yolov5 label file.
+    :param file_path: path of the tiff file, its label is expected next to it
+    :param image_file: path of the png image
+    :param label_file: path of the yolov5 label file
+    :param scale: intensity scale of preprocessing.gray_image
+    """
+    with open(_label_file(file_path), 'r', encoding='utf-8') as file:
+        label = json.load(file)
+    img_array = skimage.io.imread(file_path)
+    height, width = img_array.shape[:2]
+
+    lines = [f"{cls:d} {x / width} {(height - y) / height} {PILL_SIZE[0] / width} {PILL_SIZE[1] / height}\n"
+             for cls, pill_type in ((1, 'present'), (0, 'missing')) for x, y in label['coordinates'][pill_type]]
+    with open(label_file, 'w', encoding='utf-8') as file:
+        file.writelines(lines)
+    cv2.imwrite(image_file, gray_image(img_array, scale)[:, :, 0])
+
+
+def _convert(task):
+    """
+    Convert one file in a worker process
+    """
+    convert(*task)
+
+
+def build(source_directory, output_directory, val_fraction=0.1, workers=None, scale=INTENSITY_SCALE):
+    """
+    Build or update the training set.
+    :param source_directory: directory with the tiff files and their json labels
+    :param output_directory: directory of the training set
+    :param val_fraction: fraction of the files in the validation split
+    :param workers: number of processes (default: number of cpus)
+    :param scale: intensity scale of preprocessing.gray_image
+    :return: number of converted and of unchanged files
+    """
+    state_file = os.path.join(output_directory, STATE_FILE)
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+    current, tasks = _plan(source_directory, output_directory, val_fraction,
+                           state.get('files', {}) if state.get('scale') == scale else {})
+    tasks = [(*task, scale) for task in tasks]
+
+    _remove_stale(output_directory, state.get('files', {}), current)
+    for kind in ('images', 'labels'):
+        for split in SPLITS:
+            os.makedirs(os.path.join(output_directory, kind, split), exist_ok=True)
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_convert, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count())))))
+
+    _write_manifests(output_directory, current)
+    with open(state_file, 'w', encoding='utf-8') as file:
+        json.dump({'scale': scale, 'files': current}, file)
+    return len(tasks), len(current) - len(tasks)
+
+
+def _plan(source_directory, output_directory, val_fraction, files):
+    """
+    Assign the labelled tiff files to their splits and find the files whose outputs are missing or out of date
+    :return: the build state of every file and the (tiff file, image file, label file) of the files to convert
+    """
+    current = {}
+    tasks = []
+    for file_path in sorted(glob.glob(os.path.join(source_directory, '*.tiff'))):
+        if not os.path.exists(_label_file(file_path)):
+            continue
+        name = os.path.basename(file_path)
+        current[name] = {'split': split_of(name, val_fraction), 'source': _source_state(file_path)}
+        outputs = _outputs(output_directory, name, current[name]['split'])
+        if files.get(name) != current[name] or not all(map(os.path.exists, outputs)):
+            tasks.append((file_path, *outputs))
+    return current, tasks
+
+
+def _remove_stale(output_directory, previous, current):
+    """
+    Remove the outputs of files which have been removed or moved to the other split since the previous build
+    """
+    for name, entry in previous.items():
+        if current.get(name, {}).get('split') != entry['split']:
+            for path in _outputs(output_directory, name, entry['split']):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def _write_manifests(output_directory, files):
+    """
+    Write the split manifests and the yolov5 data file
+    """
+    output_directory = os.path.abspath(output_directory)
+    for split in SPLITS:
+        with open(os.path.join(output_directory, f'{split}.txt'), 'w', encoding='utf-8') as file:
+            file.writelines(_outputs(output_directory, name, split)[0] + '\n'
+                            for name, entry in files.items() if entry['split'] == split)
+    with open(os.path.join(output_directory, 'dataset.yaml'), 'w', encoding='utf-8') as file:
+        file.write(f"train: {os.path.join(output_directory, 'train.txt')}\n"
+                   f"val:   {os.path.join(output_directory, 'val.txt')}\n\n"
+                   f"# number of classes\nnc: {len(CLASS_NAMES):d}\n\n"
+                   f"# class names\nnames: {json.dumps(CLASS_NAMES)}\n")
+
+
+def main():
+    """
+    Command line interface
+    """
+    parser = argparse.ArgumentParser(description='Build the yolov5 training set from labelled microwave volumes')
+    parser.add_argument('source', nargs='?', default='../public_data', help='directory with tiff and json files')
+    parser.add_argument('--output', help='directory of the training set (default: <source>/yolo)')
+    parser.add_argument('--val-fraction', type=float, default=0.1, help='fraction of files in the validation split')
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of cpus)')
+    parser.add_argument('--scale', type=float, default=INTENSITY_SCALE,
+                        help=f'intensity scale of the gray images (default: {INTENSITY_SCALE}, as in inference)')
+    config = parser.parse_args()
+
+    output_directory = config.output or os.path.join(config.source, 'yolo')
+    converted, unchanged = build(config.source, output_directory, config.val_fraction, config.workers, config.scale)
+    print(f"Converted {converted:d} files, {unchanged:d} files were up to date, training set in {output_directory}")
+
 
-tiffs = []
-for file in os.listdir("../public_data/"):
-    if file.endswith(".tiff"):
-        tiffs.append(file)
-
-img_width = img_height = 257
-width = 30 / img_width
-height = 20 / img_height
-
-for filename in tiffs:
-    label_filename = "../public_data/" + filename.replace('.tiff', '.json')
-    if os.path.exists(label_filename):
-        with open(label_filename, 'r', encoding="utf-8") as file:
-            label = json.loads(file.read())
-    else:
-        continue
-    present = label["coordinates"]["present"]
-    missing = label["coordinates"]["missing"]
-    with open(f"../public_data/{filename.replace('.tiff', '.txt')}", "w", encoding="utf-8") as fo:
-        for x, y in present:
-            fo.write(f"1 {x / img_width} {(257 - y) / img_height} {width} {height}\n")
-        for x, y in missing:
-            fo.write(f"0 {x / img_width} {(257 - y) / img_height} {width} {height}\n")
-
-    img_array = skimage.io.imread(f'../public_data/{filename}')
-    img_gray = cv2.cvtColor(img_array * 100, cv2.COLOR_BGR2GRAY).astype('uint8')
-    cv2.imwrite(f"../public_data/{filename.replace('.tiff', '.png')}", img_gray)
-
-# to train the model, download the yolov5 github repo and run the following command:
-# python3 train --data pills.yaml --img-size 256 --batch-size 16 --nosave --epochs 1000 --weights
-#   yolov5n.pt --cfg yolov5n.yaml --names pills --device 0
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Headless rendering of annotated microwave volumes into contact sheets for the review of many scans.
+
+Every volume is shown as its three slices in dB (see preprocessing.db_slices) side by side, with the labelled pills as
+filled dots and the predicted pills as rings, white for present and red for missing pills. The title of a volume shows
+the labelled and predicted counts and turns red if they disagree. Many volumes are tiled into one png per sheet, the
+sheets are rendered in a process pool and contact_sheets.json lists the volumes of every sheet.
+
+The dB slices are cached as uint8 images in <output>/.db_cache, keyed by the size and modification time of the tiff
+file and the dynamic range, so rendering the same scans again, e.g. with the predictions of a later run, skips the
+decoding and the logarithm.
+
+Usage: python contact_sheets.py <data_dir> <output_dir> [--predictions <ingestion output dir>] [--disagreements]
+                                [--rows 8] [--columns 2] [--dynamic-range 25] [--workers N]
+"""
+
+import os
+import json
+import glob
+import argparse
+import importlib.util
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+import skimage.io
+from preprocessing import DYNAMIC_RANGE, db_slices
+from packed_dataset import input_files, open_pack, packed_volume
+
+CACHE_DIRECTORY = '.db_cache'
+TITLE_HEIGHT = 24  # pixels above every volume for its title
+BORDER = 4  # pixels between the slices and between the volumes
+COLORS = {'present': (255, 255, 255), 'missing': (0, 0, 255)}  # BGR, as in Model.visualize_microwave_volume
+
+
+def load_labels(data_set_directory):
+    """
+    Labels of the tiff files of a directory, from the json files next to them or from its packed dataset
+    :param data_set_directory: directory with the tiff files
+    :return: dictionary tiff file path -> label or None
+    """
+    directory = os.path.abspath(data_set_directory)
+    dataset = open_pack(directory)
+    labels = {}
+    for name in map(os.path.basename, input_files(directory)):
+        label_file = os.path.join(directory, os.path.splitext(name)[0] + '.json')
+        if os.path.exists(label_file):
+            with open(label_file, 'r', encoding='utf-8') as file:
+                labels[os.path.join(directory, name)] = json.load(file)
+        else:
+            labels[os.path.join(directory, name)] = dataset.labels.get(name) if dataset is not None else None
+    return labels
+
+
+def scoring_helpers():
+    """
+    Load the helpers of the scoring program, which shares the package name 'tools' with the ingestion program
+    """
+    path = Path(__file__).resolve().parents[1] / 'scoring_program' / 'tools' / 'helpers.py'
+    spec = importlib.util.spec_from_file_location('scoring_helpers', path)
+    helpers = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(helpers)
+    return helpers
+
+
+def load_predictions(directory):
+    """
+    Predictions written by the ingestion program, read like the scoring program reads them: from the bulk
+    predictions.jsonl if it has an index, else from the <name>.prediction files
+    :param directory: output directory of the ingestion program
+    :return: dictionary tiff file name -> prediction
+    """
+    helpers = scoring_helpers()
+    predictions = helpers.load_named_results(directory, '.prediction', helpers.BULK_PREDICTIONS)
+    return {prediction['file']: prediction for prediction in predictions.values()}
+
+
+def disagrees(label, prediction):
+    """
+    Whether the predicted pill counts differ from the labelled ones. Samples without a label or a prediction are
+    reported as disagreements, such that they are reviewed as well.
+    """
+    if label is None or prediction is None:
+        return True
+    return any(label[f'{pill_type}_pills'] != prediction[f'{pill_type}_pills'] for pill_type in COLORS)
+
+
+class ContactSheets:
+    """
+    Renderer of contact sheets with label and prediction overlays
+    """
+
+    def __init__(self, output_directory, rows=8, columns=2, dynamic_range=DYNAMIC_RANGE, workers=None):
+        """
+        :param output_directory: directory of the sheets and of the dB cache
+        :param rows: number of volumes per sheet column
+        :param columns: number of volumes per sheet row
+        :param dynamic_range: dynamic range of the slices in dB
+        :param workers: number of rendering processes (default: number of cpus)
+        """
+        self.output_directory = output_directory
+        self.layout = (rows, columns)
+        self.dynamic_range = dynamic_range
+        self.workers = workers
+
+    def render(self, data_set_directory, predictions=None, disagreements_only=False):
+        """
+        Render the volumes of a directory into contact sheets.
+        :param data_set_directory: directory with the tiff files and optionally their labels
+        :param predictions: dictionary tiff file name -> prediction, see load_predictions
+        :param disagreements_only: only render the volumes whose predicted counts differ from the labels
+        :return: list of the written sheet files
+        """
+        predictions = predictions or {}
+        samples = [(file_path, label, predictions.get(os.path.basename(file_path)))
+                   for file_path, label in load_labels(data_set_directory).items()]
+        if disagreements_only:
+            samples = [sample for sample in samples if disagrees(sample[1], sample[2])]
+
+        os.makedirs(os.path.join(self.output_directory, CACHE_DIRECTORY), exist_ok=True)
+        for sheet_file in glob.glob(os.path.join(self.output_directory, 'sheet_*.png')):  # sheets of a previous run
+            os.remove(sheet_file)
+        per_sheet = self.layout[0] * self.layout[1]
+        sheets = [(os.path.join(self.output_directory, f'sheet_{index:04d}.png'), samples[start:start + per_sheet])
+                  for index, start in enumerate(range(0, len(samples), per_sheet))]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.render_sheet, sheets))
+
+        with open(os.path.join(self.output_directory, 'contact_sheets.json'), 'w', encoding='utf-8') as file:
+            json.dump({os.path.basename(sheet_file): [os.path.basename(file_path) for file_path, *_ in sheet_samples]
+                       for sheet_file, sheet_samples in sheets}, file, indent=2)
+        return [sheet_file for sheet_file, _ in sheets]
+
+    def render_sheet(self, sheet):
+        """
+        Render and write one sheet, called in the worker processes
+        :param sheet: path of the png file and a list of (tiff file path, label, prediction)
+        """
+        sheet_file, samples = sheet
+        cells = [self._cell(*sample) for sample in samples]
+        height = max(cell.shape[0] for cell in cells)
+        width = max(cell.shape[1] for cell in cells)
+        rows, columns = self.layout
+        image = np.zeros((rows * (height + BORDER), columns * (width + BORDER), 3), np.uint8)
+        for index, cell in enumerate(cells):
+            top, left = (index // columns) * (height + BORDER), (index % columns) * (width + BORDER)
+            image[top:top + cell.shape[0], left:left + cell.shape[1]] = cell
+        used_rows = (len(cells) + columns - 1) // columns
+        cv2.imwrite(sheet_file, image[:used_rows * (height + BORDER)])
+
+    def slices(self, file_path):
+        """
+        The dB slices of a volume as uint8 image with shape MxNx3, cached in the output directory
+        :param file_path: path of the tiff file
+        """
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:  # only in the packed dataset, which is not decoded anyway
+            return self._db_slices(packed_volume(file_path))
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        cache_file = os.path.join(self.output_directory, CACHE_DIRECTORY,
+                                  f'{name}_{stat.st_size}_{stat.st_mtime_ns}_{self.dynamic_range:g}dB.npy')
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+        volume = packed_volume(file_path)
+        slices = self._db_slices(skimage.io.imread(file_path) if volume is None else volume)
+        np.save(cache_file, slices)
+        return slices
+
+    def _db_slices(self, volume):
+        return np.rint(db_slices(volume, self.dynamic_range) * 255).astype(np.uint8)
+
+    def _cell(self, file_path, label, prediction):
+        """
+        Image of one volume: its title above the colored slices with the overlays
+        """
+        slices = self.slices(file_path)
+        height, width, channels = slices.shape
+        cell = np.zeros((TITLE_HEIGHT + height, channels * (width + BORDER) - BORDER, 3), np.uint8)
+        for index in range(channels):
+            view = cell[TITLE_HEIGHT:, index * (width + BORDER):index * (width + BORDER) + width]
+            view[:] = cv2.applyColorMap(slices[:, :, index], cv2.COLORMAP_VIRIDIS)
+            _draw_pills(view, label, 4, cv2.FILLED)
+            _draw_pills(view, prediction, 9, 2)
+
+        counts = [f"{kind} {annotation['present_pills']:d}/{annotation['missing_pills']:d}"
+                  for kind, annotation in (('label', label), ('prediction', prediction)) if annotation is not None]
+        cv2.putText(cell, f"{os.path.basename(file_path)}  {'  '.join(counts)} (present/missing)",
+                    (4, TITLE_HEIGHT - 7), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                    COLORS['missing'] if disagrees(label, prediction) else COLORS['present'], 1, cv2.LINE_AA)
+        return cell
+
+
+def _draw_pills(view, annotation, radius, thickness):
+    """
+    Draw the pills of a label or prediction as circles, y is measured from the bottom of the image
+    """
+    coordinates = (annotation or {}).get('coordinates', {})
+    for pill_type, color in COLORS.items():
+        for x, y in coordinates.get(pill_type, []):
+            cv2.circle(view, (int(round(x)), int(round(view.shape[0] - y))), radius, color, thickness)
+
+
+def main():
+    """
+    Command line interface
+    """
+    parser = argparse.ArgumentParser(description='Render annotated microwave volumes into contact sheets')
+    parser.add_argument('data_set_directory', help='directory with the tiff files and their json labels')
+    parser.add_argument('output_directory')
+    parser.add_argument('--predictions', help='output directory of the ingestion program')
+    parser.add_argument('--disagreements', action='store_true',
+                        help='only render volumes whose predicted counts differ from the labels')
+    parser.add_argument('--rows', type=int, default=8, help='volumes per sheet column')
+    parser.add_argument('--columns', type=int, default=2, help='volumes per sheet row')
+    parser.add_argument('--dynamic-range', type=float, default=DYNAMIC_RANGE, help='dynamic range in dB')
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of cpus)')
+    config = parser.parse_args()
+
+    renderer = ContactSheets(config.output_directory, config.rows, config.columns, config.dynamic_range,
+                             config.workers)
+    sheets = renderer.render(config.data_set_directory,
+                             load_predictions(config.predictions) if config.predictions else None,
+                             config.disagreements)
+    print(f"Rendered {len(sheets):d} contact sheets into {config.output_directory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,15 @@ Detect a pill in a single image.
 """
 import os
 import sys
+import hashlib
+from timeit import default_timer
 from pathlib import Path
-from torch import no_grad, from_numpy, tensor
-from yolov5.models.common import DetectMultiBackend
-from yolov5.utils.general import (check_img_size, non_max_suppression, scale_coords, xyxy2xywh)
-from yolov5.utils.torch_utils import select_device
-from yolov5.utils.augmentations import letterbox
+import numpy as np
+from torch import no_grad, from_numpy
+from yolo_utils import check_img_size, non_max_suppression, scale_coords, xyxy2xywh
+from preprocessing import Preprocessor, letterbox
+from backends import TorchBackend
+from instrumentation import StageTimer
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]
@@ -16,6 +19,10 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))
 
+# detections of one image, one record per pill with its class (0: missing, 1: present), center, size and confidence
+DETECTION_DTYPE = np.dtype([('cls', np.int8), ('x', np.float64), ('y', np.float64), ('w', np.float64),
+                            ('h', np.float64), ('conf', np.float32)])
+
 
 class Detector:
     """
@@ -27,13 +34,22 @@ class Detector:
                  weights=ROOT / 'best.pt',  # model.pt path(s)
                  data=ROOT / 'pills.yaml',
                  img_size=(288, 288),  # inference size (height, width)
-                 device='cpu',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+                 backend=None,  # inference backend, see backends.py (default: pytorch on the first available device)
                  ):
 
-        self.device = select_device(device)
-        self.model = DetectMultiBackend(weights, device=self.device, dnn=False, data=data, fp16=False)
+        self.weights = weights
+        self.backend = TorchBackend() if backend is None else backend
+        self.timer = StageTimer()
+
+        tic = default_timer()
+        self.model = self.backend.load(weights, data, img_size)
+        self.startup = {'weight_load': default_timer() - tic}  # seconds spent in each startup step
         self.img_size = check_img_size(img_size, s=self.model.stride)  # check image size
+
+        tic = default_timer()
         self.model.warmup(imgsz=(1, 3, *self.img_size))
+        self.startup['warmup'] = default_timer() - tic
+        self.preprocessor = Preprocessor(self.img_size, stride=self.model.stride)
 
     @no_grad()
     def detect(self,
@@ -46,32 +62,146 @@ class Detector:
         :param image_array: the image in the form of an numpy array
         :param conf_thres: confidence threshold
         :param iou_thres: IOU threshold
-        :return: a list with the amount of present pills and the amount of missing pills
-                 plus their position and confidence
+        :return: a structured array with the class, position, size and confidence of every pill
+                 (see DETECTION_DTYPE)
         """
         original_size = image_array.shape
 
-        img = letterbox(image_array, self.img_size, stride=self.model.stride, auto=True)[0]
-        img = from_numpy(img).to(self.device)
+        with self.timer.stage('preprocess'):
+            img = letterbox(image_array, self.img_size, stride=self.model.stride, auto=True)
+            img = self._to_tensor(img[None])
+        img_shape, pred = self._inference(img, conf_thres, iou_thres)
+
+        with self.timer.stage('postprocess'):
+            return self._pills(pred[0], img_shape, original_size)
+
+    @no_grad()
+    def detect_batch(self,
+                     images,
+                     batch_size=16,  # number of images per forward pass
+                     conf_thres=0.67,  # confidence threshold
+                     iou_thres=0.45,
+                     ):
+        """
+        Detect pills on many images at once. The images are letterboxed to the fixed inference size, stacked into
+        batches of batch_size and run through a single forward pass and a single non maximum suppression per batch.
+        :param images: list of images in the form of numpy arrays
+        :param batch_size: maximum number of images per forward pass
+        :param conf_thres: confidence threshold
+        :param iou_thres: IOU threshold
+        :return: a list with one structured array of pills per image, in the same format as detect
+        """
+        pills = []
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            with self.timer.stage('preprocess', len(chunk)):
+                img = np.stack([letterbox(image_array, self.img_size, stride=self.model.stride, auto=False)
+                                for image_array in chunk])
+                img = self._to_tensor(img)
+            img_shape, pred = self._inference(img, conf_thres, iou_thres)
+            with self.timer.stage('postprocess', len(chunk)):
+                pills.extend(self._pills(det, img_shape, image_array.shape) for det, image_array in zip(pred, chunk))
+
+        return pills
+
+    @no_grad()
+    def detect_volumes(self,
+                       volumes,
+                       batch_size=16,  # number of volumes per forward pass
+                       conf_thres=0.67,  # confidence threshold
+                       iou_thres=0.45,
+                       ):
+        """
+        Detect pills on linear microwave volumes. The volumes are converted to gray, letterboxed and normalized by the
+        fused preprocessor directly into a reused input batch, see preprocessing.py.
+        :param volumes: list of microwave volumes with shape MxNx3
+        :param batch_size: maximum number of volumes per forward pass
+        :param conf_thres: confidence threshold
+        :param iou_thres: IOU threshold
+        :return: a list with one structured array of pills per volume, in the same format as detect
+        """
+        pills = []
+        for start in range(0, len(volumes), batch_size):
+            chunk = volumes[start:start + batch_size]
+            with self.timer.stage('preprocess', len(chunk)):
+                img = from_numpy(self.preprocessor.batch(chunk)).to(self.backend.device)
+                img = img.half() if self.model.fp16 else img
+            img_shape, pred = self._inference(img, conf_thres, iou_thres)
+            with self.timer.stage('postprocess', len(chunk)):
+                pills.extend(self._pills(det, img_shape, volume.shape) for det, volume in zip(pred, chunk))
+
+        return pills
+
+    def _to_tensor(self, img):
+        """
+        Convert a batch of letterboxed uint8 images into a normalized input tensor.
+        :param img: uint8 numpy array with shape BxHxWxC
+        :return: tensor with shape BxCxHxW and values between 0 and 1
+        """
+        img = from_numpy(img).to(self.backend.device)
         img = img.half() if self.model.fp16 else img.float()  # uint8 to fp16/32
         img /= 255  # 0 - 255 to 0.0 - 1.0
-        if img.ndimension() == 3:
-            img = img[None]
-        img = img.permute(0, 3, 1, 2)
+        return img.permute(0, 3, 1, 2)
+
+    def _inference(self, img, conf_thres, iou_thres):
+        """
+        Run the model and non maximum suppression on a batch of normalized images.
+        :param img: tensor with shape BxCxHxW
+        :param conf_thres: confidence threshold
+        :param iou_thres: IOU threshold
+        :return: the shape of the network input and a list with one detection tensor per image
+        """
+        with self.timer.stage('forward', len(img)), self.timer.profile():
+            pred = self.model(img, augment=False, visualize=False)
+        with self.timer.stage('nms', len(img)):
+            pred = non_max_suppression(pred, conf_thres, iou_thres, max_det=25)
 
-        pred = self.model(img, augment=False, visualize=False)
-        pred = non_max_suppression(pred, conf_thres, iou_thres, None, False, max_det=25)
-        det = pred[0]
-        det[:, :4] = scale_coords(img.shape[2:], det[:, :4], original_size).round()
+        return img.shape[2:], pred
 
-        pills = []
-        for *xyxy, conf, cls in reversed(det):
-            xywh = (xyxy2xywh(tensor(xyxy).view(1, 4))).view(-1).tolist()
-            xywh[1] = original_size[1] - xywh[1]
-            line = (cls, *xywh, conf)
-            pills.append(line)
+    @staticmethod
+    def _pills(det, img_shape, original_size):
+        """
+        Rescale the detections of one image to its original size and convert them into a structured array of pills.
+        :param det: detection tensor of one image after non maximum suppression
+        :param img_shape: shape of the network input
+        :param original_size: shape of the original image
+        :return: structured array with the fields cls, x, y, w, h and conf (see DETECTION_DTYPE)
+        """
+        det[:, :4] = scale_coords(img_shape, det[:, :4], original_size).round()
+        det = det.flip(0).cpu()  # same order as the detections were reported in before
+        xywh = xyxy2xywh(det[:, :4]).numpy()
+
+        pills = np.empty(len(det), dtype=DETECTION_DTYPE)
+        pills['cls'] = det[:, 5].numpy()
+        pills['x'] = xywh[:, 0]
+        pills['y'] = original_size[0] - xywh[:, 1].astype(np.float64)  # y is measured from the bottom
+        pills['w'] = xywh[:, 2]
+        pills['h'] = xywh[:, 3]
+        pills['conf'] = det[:, 4].numpy()
+
+        return pills
+
+    def profile_forward(self, kind, trace_file, batches=10):
+        """
+        Profile the next forward passes, see instrumentation.StageTimer.enable_profiler.
+        :param kind: 'torch' for chrome traces of the torch profiler or 'cprofile' for cProfile stats
+        :param trace_file: path of the trace output
+        :param batches: number of forward passes which are profiled
+        """
+        self.timer.enable_profiler(kind, trace_file, batches)
 
-        return pills  # array with tuples (class, x, y, w, h, confidence)
+    def fingerprint(self, conf_thres=0.67, iou_thres=0.45):
+        """
+        Fingerprint of everything which determines the detections of an image besides the image itself
+        :param conf_thres: confidence threshold
+        :param iou_thres: IOU threshold
+        :return: hex digest of the weights, the inference size, the thresholds and the backend
+        """
+        with open(self.weights, 'rb') as file:
+            digest = hashlib.sha256(file.read())
+        settings = (self.img_size, conf_thres, iou_thres, self.backend.name, getattr(self.backend, 'precision', ''))
+        digest.update(repr(settings).encode())
+        return digest.hexdigest()
 
     def get_model(self):
         """
@@ -0,0 +1,52 @@
+"""
+Evaluation of a model on a folder of labelled tiff files with the metrics of the scoring program.
+"""
+
+import os
+import json
+import importlib.util
+from pathlib import Path
+
+GATED_METRICS = ('anomaly_detection_accuracy', 'avg_sample_accuracy', 'distance')
+
+
+def scoring_metrics():
+    """
+    Load the metrics of the scoring program, which shares the package name 'tools' with the ingestion program
+    """
+    path = Path(__file__).resolve().parents[1] / 'scoring_program' / 'tools' / 'metrics.py'
+    spec = importlib.util.spec_from_file_location('scoring_metrics', path)
+    metrics = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(metrics)
+    return metrics
+
+
+def load_labels(data_set_directory, predictions):
+    """
+    Labels of the predicted files.
+    :param data_set_directory: directory with the json labels next to the tiff files
+    :param predictions: prediction dictionaries
+    :return: list with the label of every prediction
+    """
+    labels = []
+    for prediction in predictions:
+        label_file = os.path.join(data_set_directory, f"{os.path.splitext(prediction['file'])[0]}.json")
+        if not os.path.exists(label_file):
+            raise FileNotFoundError(f"Missing label {label_file}, the evaluation needs labelled samples")
+        with open(label_file, 'r', encoding='utf-8') as file:
+            labels.append(json.load(file))
+    return labels
+
+
+def evaluate(model, data_set_directory, metrics=GATED_METRICS):
+    """
+    Evaluate scoring metrics of a model on a folder of labelled tiff files.
+    :param model: Model instance
+    :param data_set_directory: directory with tiff files and their json labels
+    :param metrics: names of the metrics of the scoring program
+    :return: dictionary with the value of every metric
+    """
+    scoring = scoring_metrics()
+    predictions = model.predict(data_set_directory)
+    labels = load_labels(data_set_directory, predictions)
+    return {name: getattr(scoring, name)(labels, predictions) for name in metrics}
@@ -0,0 +1,89 @@
+"""
+Inference profile: the fastest inference settings of a machine, written by autotune.py and loaded by Model.
+
+The profile is a json file with the backend and its settings (e.g. thread counts), the batch size and the number of
+worker processes, together with a description of the machine it has been tuned on. A profile which has been tuned on a
+different machine is ignored, such that a profile copied with the submission never slows down another node.
+
+The profile is read from inference_profile.json next to this file, or from the path in the environment variable
+DETECTOR_PROFILE. Setting DETECTOR_PROFILE to an empty string disables the profile.
+"""
+
+import os
+import json
+import platform
+from pathlib import Path
+
+PROFILE_FILE = Path(__file__).resolve().parent / 'inference_profile.json'
+
+
+def machine():
+    """
+    Description of the hardware which determines the best settings. The cpus are those of the machine, not the ones
+    this process may run on, such that the worker processes of the sharded ingestion, which are pinned to their share
+    of the cpus, load the same profile as the process which has been tuned.
+    :return: dictionary with the architecture, processor, operating system and the number of cpus
+    """
+    return {'machine': platform.machine(), 'processor': platform.processor(), 'system': platform.system(),
+            'cpus': os.cpu_count()}
+
+
+def usable_cpus():
+    """
+    Number of cpus this process may run on
+    """
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def backend_settings(profile):
+    """
+    Backend settings of a profile with the thread counts limited to the cpus this process may run on. The counts have
+    been tuned for the number of worker processes of the profile, a worker of a run with more processes is pinned to
+    fewer cpus and would oversubscribe them.
+    :param profile: dictionary with backend_settings, e.g. a loaded profile
+    :return: keyword arguments of the backend
+    """
+    settings = dict(profile.get('backend_settings', {}))
+    for name in ('intra_op_threads', 'inter_op_threads'):
+        if settings.get(name):
+            settings[name] = min(settings[name], usable_cpus())
+    return settings
+
+
+def profile_path():
+    """
+    Path of the profile or None if the profile is disabled
+    """
+    path = os.environ.get('DETECTOR_PROFILE', str(PROFILE_FILE))
+    return Path(path) if path else None
+
+
+def load_profile(path=None):
+    """
+    Read the profile of this machine.
+    :param path: path of the profile (default: see profile_path)
+    :return: dictionary with backend, backend_settings, batch_size and processes, or None if there is no profile for
+             this machine
+    """
+    path = path or profile_path()
+    if path is None or not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as file:
+        profile = json.load(file)
+    if profile.get('machine') != machine():
+        print(f"Ignoring the inference profile {path}, it has been tuned on a different machine")
+        return None
+    return profile
+
+
+def save_profile(profile, path=None):
+    """
+    Write the profile of this machine.
+    :param profile: dictionary with backend, backend_settings, batch_size and processes
+    :param path: path of the profile (default: see profile_path)
+    :return: path of the written profile
+    """
+    path = Path(path or profile_path() or PROFILE_FILE)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({**profile, 'machine': machine()}, file, indent=2)
+    return path
@@ -0,0 +1,163 @@
+"""
+Low overhead per-stage latency instrumentation of the prediction pipeline.
+
+Every stage keeps constant size accumulators instead of the individual calls: the number of calls and images, the total
+time and a histogram of the per-image latencies with logarithmic buckets. The percentiles are read from the histogram,
+their relative error is below half a bucket (1.2 %).
+"""
+
+import math
+import cProfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from timeit import default_timer
+import numpy as np
+from torch import autograd
+
+MIN_LATENCY = 1e-6  # seconds, lower edge of the first bucket, faster calls are counted in the first bucket
+BUCKETS_PER_DECADE = 100
+BUCKETS = 9 * BUCKETS_PER_DECADE  # up to 1000 s, slower calls are counted in the last bucket
+
+
+class StageStats:
+    """
+    Accumulated latencies of one pipeline stage
+    """
+
+    __slots__ = ('calls', 'images', 'total', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.images = 0
+        self.total = 0.0
+        self.histogram = np.zeros(BUCKETS, dtype=np.int64)  # number of images per latency bucket
+
+    def add(self, seconds, images):
+        """
+        Add a call which processed images in seconds, every image counts with the duration divided by images
+        """
+        self.calls += 1
+        self.images += images
+        self.total += seconds
+        if images > 0:
+            per_image = seconds / images
+            bucket = int(math.log10(per_image / MIN_LATENCY) * BUCKETS_PER_DECADE) if per_image > MIN_LATENCY else 0
+            self.histogram[min(bucket, BUCKETS - 1)] += images
+
+    def percentiles(self, quantiles):
+        """
+        Nearest rank percentiles of the per-image latencies, the geometric centers of their buckets
+        :param quantiles: fractions between 0 and 1
+        :return: list of seconds, zeros if no image has been processed
+        """
+        counts = np.cumsum(self.histogram)
+        if not counts[-1]:
+            return [0.0] * len(quantiles)
+        buckets = np.searchsorted(counts, [max(1, math.ceil(q * counts[-1])) for q in quantiles])
+        return [MIN_LATENCY * 10 ** ((bucket + 0.5) / BUCKETS_PER_DECADE) for bucket in buckets.tolist()]
+
+
+class StageTimer:
+    """
+    Records the latency of every call of a pipeline stage together with the number of images it processed
+    """
+
+    def __init__(self):
+        self.stages = {}  # stage -> StageStats
+        self._lock = threading.Lock()  # stages are also timed in the prefetch threads
+        self.profiler = None  # 'torch', 'cprofile' or None, see enable_profiler
+        self.trace_file = None
+        self.batches = 0  # number of forward passes which are still profiled
+        self._cprofile = cProfile.Profile()
+
+    @contextmanager
+    def stage(self, name, images=1):
+        """
+        Context which times the enclosed stage.
+        :param name: name of the stage, e.g. 'forward'
+        :param images: number of images processed by this call
+        """
+        tic = default_timer()
+        try:
+            yield
+        finally:
+            self.record(name, default_timer() - tic, images)
+
+    def record(self, name, seconds, images=1):
+        """
+        Record a stage which has been timed elsewhere.
+        :param name: name of the stage, e.g. 'write'
+        :param seconds: duration of the call
+        :param images: number of images processed by this call
+        """
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            self.stages[name].add(seconds, images)
+
+    def reset(self):
+        """
+        Forget all recorded stages
+        """
+        with self._lock:
+            self.stages.clear()
+
+    def enable_profiler(self, kind, trace_file, batches=10):
+        """
+        Profile the next forward passes with the torch profiler (one chrome trace per pass) or cProfile (one stats
+        file accumulating all passes).
+        :param kind: 'torch' or 'cprofile'
+        :param trace_file: path of the trace, e.g. 'forward.json' for the torch profiler or 'forward.prof' for cProfile
+        :param batches: number of forward passes which are profiled
+        """
+        if kind not in ('torch', 'cprofile'):
+            raise ValueError(f"Unknown profiler {kind}, use 'torch' or 'cprofile'")
+        self.profiler = kind
+        self.trace_file = Path(trace_file)
+        self.batches = batches
+
+    @contextmanager
+    def profile(self):
+        """
+        Context which profiles the enclosed forward pass if the profiler is enabled
+        """
+        if self.profiler is None or self.batches <= 0:
+            yield
+            return
+
+        self.batches -= 1
+        if self.profiler == 'cprofile':
+            self._cprofile.enable()
+            try:
+                yield
+            finally:
+                self._cprofile.disable()
+                self._cprofile.dump_stats(str(self.trace_file))
+        else:
+            with autograd.profiler.profile() as prof:
+                yield
+            calls = self.stages['forward'].calls if 'forward' in self.stages else 0
+            prof.export_chrome_trace(str(self.trace_file.with_name(
+                f'{self.trace_file.stem}_{calls}{self.trace_file.suffix}')))
+
+    def summary(self):
+        """
+        Summary of every stage. Latencies are per image, i.e. a batched call counts as its duration divided by the
+        batch size for each of its images.
+        :return: dictionary stage -> calls, images, total, p50, p95, p99 (seconds) and images_per_second
+        """
+        summary = {}
+        with self._lock:
+            for name, stats in self.stages.items():
+                p50, p95, p99 = stats.percentiles((0.5, 0.95, 0.99))
+                summary[name] = {
+                    'calls': stats.calls,
+                    'images': stats.images,
+                    'total': stats.total,
+                    'p50': p50,
+                    'p95': p95,
+                    'p99': p99,
+                    'images_per_second': stats.images / stats.total if stats.total > 0 else 0.0,
+                }
+        return summary
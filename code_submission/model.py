@@ -19,21 +19,45 @@ The following convenience methods are provided:
 
 import os
 import json
-import glob
-import copy
-import numpy as np
+import importlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import skimage.io
-from matplotlib import pyplot as plt
-from cv2 import cvtColor
 from detect_single import Detector
+from preprocessing import db_slices
+from backends import BACKENDS
+from prediction_cache import PredictionCache
+from tiling import TiledDetector
+from packed_dataset import input_files as tiff_files, open_pack, packed_volume
+from inference_profile import backend_settings, load_profile
+from results import PredictionResults, prediction_dict
 
 
-def _gray_img(file_path):
-    img_array = skimage.io.imread(f'{file_path}')
-    img_gray = cvtColor(img_array * 50, 6).astype('uint8')
-    img_array = cvtColor(img_gray, 8)
+def _prefetch(function, items, executor, depth):
+    """
+    Apply function to the items in a thread pool and yield the results in order. At most depth results are decoded
+    ahead of the consumer, which bounds the memory of the queue.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+    while pending:
+        yield pending.popleft().result()
 
-    return img_array
+
+def _file_content(file_path):
+    """
+    Bytes of a tiff file, or of its packed volume if only the packed dataset is present
+    """
+    if not os.path.exists(file_path):
+        volume = packed_volume(file_path)
+        if volume is not None:
+            return volume.tobytes()
+    with open(file_path, 'rb') as file:
+        return file.read()
 
 
 class Model:
@@ -41,14 +65,97 @@ class Model:
     Model to predict, Elon Musk would approve!
     """
 
-    def __init__(self):
+    def __init__(self, batch_size=None, prefetch=32, workers=4, backend=None):
         """
         Initialize the class instance
 
         Important: If you want to refer to relative paths, e.g., './subdir', use
         os.path.join(os.path.dirname(__file__), 'subdir')
+
+        :param int batch_size: Number of images which are passed through the detector at once (default: the inference
+                               profile or 16)
+        :param int prefetch: Maximum number of images which are read ahead of inference (default: 32)
+        :param int workers: Number of threads reading images (default: 4)
+        :param backend: Name of the inference backend ('torch', 'torchscript', 'onnx' or 'onnx-int8') or a backend
+                        instance, e.g. backends.OnnxBackend(intra_op_threads=4) (default: the environment variable
+                        DETECTOR_BACKEND, the inference profile or 'torch')
+
+        The inference profile of this machine (see autotune.py and inference_profile.py) provides the batch size and
+        the backend with its thread settings which are not given explicitly.
+
+        If the environment variable DETECTOR_SERVER is set to the address of a running server.py, the model is a thin
+        client which sends the tiff files to the server and no detector is loaded in this process.
+        """
+        if os.environ.get('DETECTOR_SERVER'):
+            self.model = importlib.import_module('server').InferenceClient(os.environ['DETECTOR_SERVER'])
+            self.tiler = None
+        else:
+            profile = load_profile() or {}
+            if backend is None:
+                backend = os.environ.get('DETECTOR_BACKEND') or \
+                    BACKENDS[profile.get('backend', 'torch')](**backend_settings(profile))
+            self.model = Detector(backend=BACKENDS[backend]() if isinstance(backend, str) else backend)
+            self.tiler = TiledDetector(self.model)  # volumes larger than a tile are detected in overlapping tiles
+            batch_size = batch_size or profile.get('batch_size')
+        self.batch_size = batch_size or 16
+        self.prefetch = max(prefetch, self.batch_size)
+        # the reader threads are kept for the life of the model, e.g. for the micro-batches of the inference server
+        self.readers = ThreadPoolExecutor(max_workers=workers)
+        self.cache = None
+        self.cascade = None
+
+    @property
+    def remote(self):
+        """
+        Whether the model is a thin client of an inference server
+        """
+        return self.tiler is None
+
+    @property
+    def startup(self):
+        """
+        Seconds spent in each startup step of the detector, or in connecting to the inference server
+        """
+        return self.model.startup
+
+    @property
+    def timer(self):
+        """
+        Per-stage latencies, see instrumentation.StageTimer
+        """
+        return self.model.timer
+
+    def use_cache(self, path, max_entries=1000000):
+        """
+        Cache the detections of every tiff file in a persistent database. Files whose content has been predicted
+        before with the same weights and settings are neither decoded nor inferred again.
+
+        :param string path: Path of the SQLite database
+        :param int max_entries: Maximum number of cached files, the least recently used are evicted first
+        """
+        if self.remote:
+            print('The prediction cache of a thin client is ignored, start the server with --cache instead')
+            return
+        fingerprint = self.model.fingerprint() + repr((self.tiler.tile_size, self.tiler.overlap))
+        if self.cascade is not None:
+            fingerprint += repr((self.cascade.lattice, self.cascade.threshold, self.cascade.margin,
+                                 self.cascade.min_confidence))
+        self.cache = PredictionCache(path, fingerprint, max_entries)
+
+    def use_cascade(self, cascade=None):
         """
-        self.model = Detector(device='0')
+        Answer routine images with the classical pre-screen and escalate only the uncertain ones to the detector, see
+        cascade.py. Has to be called before use_cache, such that the cached detections depend on the pre-screen.
+
+        :param cascade: calibrated cascade.PreScreen or path of its calibration file (default: cascade.json next to
+                        this file)
+        """
+        if self.cache is not None:
+            raise RuntimeError('use_cascade has to be called before use_cache')
+        if cascade is None or isinstance(cascade, (str, os.PathLike)):
+            module = importlib.import_module('cascade')  # only imported when the cascade is used
+            cascade = module.PreScreen.load(cascade or module.DEFAULT_FILE)
+        self.cascade = cascade
 
     def predict(self, data_set_directory):
         """
@@ -57,39 +164,121 @@ class Model:
         Make sure that the predictions are in the correct format for the scoring metric. The method should return an
         array of dictionaries, where the number of dictionaries must match the number of tiff files in
         data_set_dictionary.
+
+        The predictions are returned as results.PredictionResults, a sequence which stores the predictions in a few
+        numpy arrays and builds a plain prediction dictionary whenever one is accessed.
         """
 
-        input_files = glob.glob(os.path.join(os.path.abspath(data_set_directory), '*.tiff'))
-
-        example_prediction = {
-            'file': '',  # filename of the input image
-            'missing_pills': 0,  # number of missing pills
-            'present_pills': 0,  # number of present pills
-            'coordinates': {
-                'missing': [  # centroids of missing pills. The order of the centroids is arbitrary.
-                ],
-                'present': [  # centroids of present pills. The order of the centroids is arbitrary.
-                ]
-            }
-        }
-
-        file_predictions = []
-        for file_path in input_files:
-            img = _gray_img(file_path)
-
-            prediction = copy.deepcopy(example_prediction)
-            prediction['file'] = os.path.basename(file_path)
-            predictions = self.model.detect(img)
-            for cls, x, y, _, _, _ in predictions:
-                if cls == 1:
-                    prediction['present_pills'] += 1
-                    prediction['coordinates']['present'].append((x, y))
-                else:
-                    prediction['missing_pills'] += 1
-                    prediction['coordinates']['missing'].append((x, y))
-            file_predictions.append(prediction)
-        # return list of dictionaries whose length matches the number of tiff files
-        return file_predictions
+        results = PredictionResults()
+        if self.remote:
+            for prediction in self.predict_iter(data_set_directory):
+                results.append_prediction(prediction)
+            return results
+
+        for file_path, detections in self._detections(tiff_files(data_set_directory)):
+            with self.timer.stage('format'):
+                results.append(file_path, detections)
+
+        # sequence of dictionaries whose length matches the number of tiff files
+        return results
+
+    def predict_iter(self, data_set_directory):
+        """
+        Generator version of predict which yields the prediction of every tiff file in data_set_directory as soon as
+        its batch has been processed. Only the prefetch queue and the current batch are kept in memory.
+
+        If the directory has been packed (see packed_dataset.py), the volumes listed in the pack are predicted as well,
+        also if their tiff files have been removed, and tiff files which have been added after the packing are read as
+        usual.
+
+        :param string data_set_directory: Directory containing the tiff files
+        :return: generator of prediction dictionaries
+        """
+
+        yield from self.predict_files(tiff_files(data_set_directory))
+
+    def predict_files(self, input_files):
+        """
+        Generator which yields the prediction of every given tiff file as soon as its batch has been processed.
+
+        :param list input_files: Paths to tiff files
+        :return: generator of prediction dictionaries
+        """
+
+        if self.remote:
+            yield from self.model.predict_files(input_files)
+            return
+
+        for file_path, detections in self._detections(input_files):
+            with self.timer.stage('format'):
+                prediction = prediction_dict(file_path, detections)
+            yield prediction
+
+    def _detections(self, input_files):
+        """
+        Generator which yields the file path and the detections of every given tiff file, from the prediction cache or
+        from the detector, as soon as its batch has been processed.
+
+        :param list input_files: Paths to tiff files
+        :return: generator of (file path, structured array of pills)
+        """
+
+        # volumes are read in background threads while the current batch is running inference
+        samples = _prefetch(self._load, input_files, self.readers, self.prefetch)
+
+        while chunk := list(islice(samples, self.batch_size)):
+            volumes = [volume for *_, volume in chunk if volume is not None]
+            inferred = self._detect(volumes)
+
+            results = []
+            new_entries = []
+            for file_path, key, detections, volume in chunk:
+                if volume is not None:
+                    detections = inferred[len(new_entries)]
+                    new_entries.append((key, detections))
+                results.append((file_path, detections))
+            if self.cache is not None:
+                self.cache.put_many(new_entries)  # also writes the last use of the cache hits of the batch
+
+            yield from results
+
+    def _detect(self, volumes):
+        """
+        Detect pills on volumes. With a cascade, the volumes are pre-screened first and only the uncertain ones are
+        passed to the detector. Volumes which fit into a tile are batched, larger scenes are split into batches of
+        overlapping tiles.
+
+        :param list volumes: Microwave volumes
+        :return: list with one structured array of pills per volume
+        """
+        screened = [None] * len(volumes)
+        if self.cascade is not None:
+            with self.timer.stage('prescreen', len(volumes)):
+                screened = [self.cascade.detect(volume) for volume in volumes]  # None for escalated volumes
+
+        escalated = [volume for volume, pills in zip(volumes, screened) if pills is None]
+        batched = iter(self.model.detect_volumes([volume for volume in escalated if self.tiler.fits(volume.shape)],
+                                                 self.batch_size))
+        return [pills if pills is not None else next(batched) if self.tiler.fits(volume.shape)
+                else self.tiler.detect(volume, self.batch_size) for volume, pills in zip(volumes, screened)]
+
+    def _load(self, file_path):
+        """
+        Look up the detections of a tiff file in the prediction cache and read the volume if they are not cached.
+
+        :param string file_path: Path to tiff file
+        :return: the file path, the cache key, the cached detections or None and the volume or None
+        """
+        key = detections = volume = None
+        if self.cache is not None:
+            with self.timer.stage('cache'):
+                key = self.cache.key(_file_content(file_path))
+                detections = self.cache.get(key)
+        if detections is None:
+            with self.timer.stage('decode'):
+                volume = Model.load_microwave_volume(file_path)
+
+        return file_path, key, detections, volume
 
     @staticmethod
     def load_microwave_volume(input_file):
@@ -97,10 +286,16 @@ class Model:
         Load microwave volume from tiff file. Each provided volume contains three slices in propagation direction. The
         provided microwave volumes are given in linear scale.
 
+        Volumes of a packed dataset (see packed_dataset.py) are returned as read-only zero-copy views into its memory
+        map, as long as the tiff file is missing or unchanged since the packing.
+
         :param string input_file: Path to tiff file
         :return ndarray: Image as ndarray with shape MxNx3
         """
 
+        volume = packed_volume(input_file)
+        if volume is not None:
+            return volume
         return skimage.io.imread(input_file)
 
     @staticmethod
@@ -111,6 +306,7 @@ class Model:
         :param float dynamic_range: Dynamic range in dB (default: 25)
         """
 
+        plt = importlib.import_module('matplotlib.pyplot')  # only needed for visualization, slow to import
         img = Model.load_microwave_volume(input_file)
 
         if label is None:
@@ -118,21 +314,22 @@ class Model:
             if os.path.exists(label_filename):
                 with open(label_filename, 'r', encoding='utf-8') as file:
                     label = json.loads(file.read())
+            elif open_pack(os.path.dirname(os.path.abspath(input_file))) is not None:  # labels stored in the pack
+                label = open_pack(os.path.dirname(os.path.abspath(input_file))).labels.get(os.path.basename(input_file))
 
         fig, axs = plt.subplots(1, 3, figsize=(16, 7))
+        slices = db_slices(img, dynamic_range)  # 0 at dynamic_range below the maximum of a slice, 1 at its maximum
         for i in range(img.shape[2]):
-            volume = 20 * np.log10(img[:, :, i])
-            max_val = np.max(volume)
-            axs[i].imshow(volume, vmax=max_val, vmin=max_val - dynamic_range)
+            axs[i].imshow(slices[:, :, i], vmin=0, vmax=1)
             axs[i].set_title(f"Slice {i + 1:d}")
 
             if label is not None:
                 x_coords = [coord[0] for coord in label['coordinates']['present']]
-                y_coords = [257 - coord[1] for coord in label['coordinates']['present']]
+                y_coords = [img.shape[0] - coord[1] for coord in label['coordinates']['present']]
                 axs[i].scatter(x_coords, y_coords, color='white')
 
                 x_coords = [coord[0] for coord in label['coordinates']['missing']]
-                y_coords = [257 - coord[1] for coord in label['coordinates']['missing']]
+                y_coords = [img.shape[0] - coord[1] for coord in label['coordinates']['missing']]
                 axs[i].scatter(x_coords, y_coords, color='red')
 
         if label is not None:
@@ -0,0 +1,169 @@
+"""
+Packed dataset: all microwave volumes of a directory in a single memory mapped file.
+
+The pack consists of the raw volume data (volumes.pack) and an index (volumes.pack.index) with the offset, shape and
+dtype of every volume, the size and modification time of its source tiff file and optionally its json label. Volumes
+are returned as zero-copy views into the memory map, so repeated runs over the same directory skip the tiff decoding
+and are served from the page cache. A packed volume is only used while its source tiff file is missing or unchanged,
+tiff files which have been added after the packing are read as usual.
+
+Usage: python packed_dataset.py <directory> [--no-labels]
+"""
+
+import os
+import json
+import glob
+import argparse
+import numpy as np
+import skimage.io
+
+PACK_FILE = 'volumes.pack'
+ALIGNMENT = 64  # byte alignment of every volume within the pack
+_OPEN_PACKS = {}  # directory -> (state of the index file, PackedDataset)
+
+
+class PackedDataset:
+    """
+    Read-only view of a packed dataset
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the pack file, the index is expected at <path>.index
+        """
+        with open(f'{path}.index', 'r', encoding='utf-8') as file:
+            index = json.load(file)
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.entries = index['volumes']
+        self.labels = index.get('labels', {})
+        self.data = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else np.empty(0, np.uint8)
+
+    def names(self):
+        """
+        Sorted file names of the packed volumes
+        """
+        return sorted(self.entries)
+
+    def volume(self, name):
+        """
+        Zero-copy view of a packed volume
+        :param name: file name of the volume, e.g. 'image_0001.tiff'
+        :return: read-only ndarray with shape MxNx3
+        """
+        entry = self.entries[name]
+        dtype = np.dtype(entry['dtype'])
+        size = int(np.prod(entry['shape'])) * dtype.itemsize
+        return self.data[entry['offset']:entry['offset'] + size].view(dtype).reshape(entry['shape'])
+
+    def is_current(self, name):
+        """
+        Whether a volume is packed and its source tiff file is missing or unchanged since the packing
+        :param name: file name of the volume
+        """
+        if name not in self.entries:
+            return False
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return True
+        return [stat.st_size, stat.st_mtime_ns] == self.entries[name]['source']
+
+
+def open_pack(directory):
+    """
+    Packed dataset of a directory, opened again only when its index file has changed, such that long running processes
+    see packs which are created or rewritten after their first lookup
+    :param directory: absolute path of the directory
+    :return: PackedDataset or None if the directory has not been packed
+    """
+    path = os.path.join(directory, PACK_FILE)
+    try:
+        stat = os.stat(f'{path}.index')
+    except FileNotFoundError:
+        _OPEN_PACKS.pop(directory, None)
+        return None
+    state = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _OPEN_PACKS.get(directory)
+    if cached is not None and cached[0] == state:
+        return cached[1]
+    dataset = PackedDataset(path) if os.path.exists(path) else None
+    _OPEN_PACKS[directory] = (state, dataset)
+    return dataset
+
+
+def input_files(directory):
+    """
+    Paths of the tiff files of a directory and of the packed volumes whose tiff files are missing
+    :param directory: directory with the tiff files
+    :return: sorted list of absolute paths
+    """
+    directory = os.path.abspath(directory)
+    dataset = open_pack(directory)
+    names = {os.path.basename(file_path) for file_path in glob.glob(os.path.join(directory, '*.tiff'))}
+    names.update(dataset.names() if dataset is not None else [])
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+
+def packed_volume(file_path):
+    """
+    Look up a tiff file in the pack of its directory.
+    :param file_path: path of the tiff file
+    :return: zero-copy view of the volume or None if it is not packed or the tiff file has changed
+    """
+    dataset = open_pack(os.path.dirname(os.path.abspath(file_path)))
+    name = os.path.basename(file_path)
+    if dataset is None or not dataset.is_current(name):
+        return None
+    return dataset.volume(name)
+
+
+def pack(directory, labels=True):
+    """
+    Pack all tiff files of a directory into <directory>/volumes.pack. The pack and its index are written to temporary
+    files and renamed into place, the index of the previous pack is removed before, such that an interrupted packing
+    never leaves an index which points into a different pack.
+    :param directory: directory with the tiff files
+    :param labels: also store the json labels next to the tiff files in the index
+    :return: number of packed volumes
+    """
+    path = os.path.join(directory, PACK_FILE)
+    index = {'volumes': {}, 'labels': {}}
+    with open(f'{path}.tmp', 'wb') as file:
+        for file_path in sorted(glob.glob(os.path.join(directory, '*.tiff'))):
+            name = os.path.basename(file_path)
+            stat = os.stat(file_path)
+            volume = np.ascontiguousarray(skimage.io.imread(file_path))
+            file.write(b'\0' * (-file.tell() % ALIGNMENT))
+            index['volumes'][name] = {'offset': file.tell(), 'shape': list(volume.shape), 'dtype': volume.dtype.str,
+                                      'source': [stat.st_size, stat.st_mtime_ns]}
+            file.write(volume.tobytes())
+
+            label_file = os.path.splitext(file_path)[0] + '.json'
+            if labels and os.path.exists(label_file):
+                with open(label_file, 'r', encoding='utf-8') as label:
+                    index['labels'][name] = json.load(label)
+
+    with open(f'{path}.index.tmp', 'w', encoding='utf-8') as file:
+        json.dump(index, file)
+    if os.path.exists(f'{path}.index'):
+        os.remove(f'{path}.index')
+    os.replace(f'{path}.tmp', path)
+    os.replace(f'{path}.index.tmp', f'{path}.index')
+    return len(index['volumes'])
+
+
+def main():
+    """
+    Command line interface
+    """
+    parser = argparse.ArgumentParser(description='Pack the tiff volumes of a directory into a memory mapped file')
+    parser.add_argument('directory')
+    parser.add_argument('--no-labels', action='store_true', help='do not store the json labels')
+    config = parser.parse_args()
+
+    count = pack(config.directory, labels=not config.no_labels)
+    print(f"Packed {count:d} volumes into {os.path.join(config.directory, PACK_FILE)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Persistent cache of detections, keyed by the content of the tiff file and a fingerprint of the detector.
+"""
+
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from detect_single import DETECTION_DTYPE
+
+
+class PredictionCache:
+    """
+    SQLite backed cache of the detections of tiff files with least recently used eviction
+    """
+
+    def __init__(self, path, fingerprint, max_entries=1000000):
+        """
+        :param path: path of the SQLite database
+        :param fingerprint: fingerprint of the detector, see Detector.fingerprint
+        :param max_entries: maximum number of cached files, the least recently used entries are evicted first
+        """
+        self.fingerprint = fingerprint.encode()
+        self.max_entries = max_entries
+        self.lookups = {'hits': 0, 'misses': 0}  # of this run
+        self._touched = {}  # key -> last use of the hits since the last write, written with the next put_many
+        self._lock = threading.Lock()  # the cache is shared with the threads reading the tiff files
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS detections '
+                                 '(key TEXT PRIMARY KEY, detections BLOB NOT NULL, last_used INTEGER NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS detections_last_used ON detections (last_used)')
+        self._connection.commit()
+        # upper bound of the number of cached files, counted again only when it exceeds max_entries
+        self._entries = self._connection.execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+
+    def key(self, data):
+        """
+        Cache key of the content of a tiff file
+        :param data: bytes of the tiff file
+        :return: hex digest of the content and the fingerprint
+        """
+        return hashlib.sha256(self.fingerprint + data).hexdigest()
+
+    def get(self, key):
+        """
+        Look up the detections of a tiff file.
+        :param key: cache key, see key
+        :return: structured array of detections or None on a miss
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT detections FROM detections WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.lookups['misses'] += 1
+                return None
+            self.lookups['hits'] += 1
+            self._touched[key] = time.time_ns()
+        return np.frombuffer(row[0], dtype=DETECTION_DTYPE)
+
+    def put_many(self, entries):
+        """
+        Store detections, write the last use of the hits since the previous call and evict the least recently used
+        entries beyond max_entries, all in one transaction. Called once per batch, also without new entries.
+        :param entries: iterable of (key, structured array of detections)
+        """
+        now = time.time_ns()
+        rows = [(key, detections.tobytes(), now) for key, detections in entries]
+        with self._lock:
+            if not rows and not self._touched:
+                return
+            self._write_touched()
+            self._connection.executemany('INSERT OR REPLACE INTO detections VALUES (?, ?, ?)', rows)
+            self._entries += len(rows)
+            if self._entries > self.max_entries:  # the count includes the entries which other processes have added
+                self._entries = self._connection.execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+                if self._entries > self.max_entries:
+                    self._connection.execute('DELETE FROM detections WHERE key IN (SELECT key FROM detections '
+                                             'ORDER BY last_used LIMIT ?)', (self._entries - self.max_entries,))
+                    self._entries = self.max_entries
+            self._connection.commit()
+
+    def _write_touched(self):
+        """
+        Write the last use of the buffered hits, the caller holds the lock and commits
+        """
+        self._connection.executemany('UPDATE detections SET last_used = ? WHERE key = ?',
+                                     [(last_used, key) for key, last_used in self._touched.items()])
+        self._touched.clear()
+
+    def stats(self):
+        """
+        Hit and miss counters of this run and the number of cached files
+        """
+        with self._lock:
+            entries = self._connection.execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+        return {**self.lookups, 'entries': entries}
+
+    def close(self):
+        """
+        Close the database, the last use of the buffered hits is written first
+        """
+        with self._lock:
+            self._write_touched()
+            self._connection.commit()
+            self._connection.close()
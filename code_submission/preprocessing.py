@@ -0,0 +1,172 @@
+"""
+Preprocessing of microwave volumes for the detector.
+
+The reference path (gray_image followed by the letterbox of yolov5) scales the linear volume, converts it to gray,
+casts it to uint8, copies the gray values into three channels, letterboxes the image, converts it into a float tensor,
+normalizes it and permutes it into NCHW order. Preprocessor fuses these steps for fixed input shapes: the letterbox
+geometry is computed once per input shape and the scaled gray values are written directly into a preallocated NCHW
+float32 batch, using scratch buffers which are reused for every image.
+
+Tolerance: the fused path is bit-for-bit identical to the reference path for all pixels whose scaled gray value lies
+within [0, 256). Out of range values are clipped to [0, 255], whereas the reference cast to uint8 wraps them around.
+"""
+
+import threading
+from collections import namedtuple
+import numpy as np
+import cv2
+
+INTENSITY_SCALE = 50  # factor applied to the linear microwave volume before the conversion to uint8
+PAD_VALUE = 114  # gray value of the letterbox border
+DYNAMIC_RANGE = 25  # dB below the maximum of a slice which are shown, as in Model.visualize_microwave_volume
+
+Geometry = namedtuple('Geometry', ['resize', 'top', 'left', 'height', 'width'])
+
+
+def gray_image(img_array, scale=INTENSITY_SCALE):
+    """
+    Convert a linear microwave volume into a three channel uint8 gray image (reference path).
+    :param img_array: microwave volume with shape MxNx3
+    :param scale: factor applied to the volume before the conversion to uint8
+    :return: uint8 image with shape MxNx3
+    """
+    img_gray = cv2.cvtColor(img_array * scale, cv2.COLOR_BGR2GRAY).astype('uint8')
+    return cv2.cvtColor(img_gray, cv2.COLOR_GRAY2BGR)
+
+
+def db_slices(volume, dynamic_range=DYNAMIC_RANGE):
+    """
+    Convert the slices of a linear microwave volume into dB, normalized to [0, 1] over the dynamic range below the
+    maximum of each slice.
+    :param volume: microwave volume with shape MxNx3
+    :param dynamic_range: dynamic range in dB
+    :return: float32 array with shape MxNx3
+    """
+    channels = volume.shape[2]
+    relative = np.maximum(volume, np.finfo(np.float32).tiny, dtype=np.float32)
+    relative /= relative.reshape(-1, channels).max(axis=0)  # 0 dB at the maximum of every slice
+    normalized = cv2.log(relative) * np.float32(20 / (np.log(10) * dynamic_range)) + np.float32(1)
+    return np.clip(normalized, 0, 1, out=normalized)
+
+
+def letterbox_geometry(shape, new_shape, stride=32, auto=False):
+    """
+    Compute the letterbox geometry of yolov5's letterbox for an image shape.
+    :param shape: shape of the input image (height, width, ...)
+    :param new_shape: inference size (height, width)
+    :param stride: model stride
+    :param auto: pad to the minimum rectangle which is a multiple of the stride instead of new_shape
+    :return: Geometry with the resized size (width, height), the top and left padding and the output size
+    """
+    ratio = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    new_unpad = int(round(shape[1] * ratio)), int(round(shape[0] * ratio))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]
+    if auto:
+        dw, dh = np.mod(dw, stride), np.mod(dh, stride)
+    dw /= 2
+    dh /= 2
+
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return Geometry(new_unpad, top, left, new_unpad[1] + top + bottom, new_unpad[0] + left + right)
+
+
+def letterbox(img, new_shape, stride=32, auto=False):
+    """
+    Resize and pad an image like yolov5's letterbox (reference path).
+    :param img: uint8 image with shape MxNx3
+    :param new_shape: inference size (height, width)
+    :param stride: model stride
+    :param auto: pad to the minimum rectangle which is a multiple of the stride instead of new_shape
+    :return: letterboxed uint8 image
+    """
+    geometry = letterbox_geometry(img.shape, new_shape, stride, auto)
+    if img.shape[1::-1] != geometry.resize:
+        img = cv2.resize(img, geometry.resize, interpolation=cv2.INTER_LINEAR)
+    bottom = geometry.height - geometry.resize[1] - geometry.top
+    right = geometry.width - geometry.resize[0] - geometry.left
+    return cv2.copyMakeBorder(img, geometry.top, bottom, geometry.left, right, cv2.BORDER_CONSTANT,
+                              value=(PAD_VALUE,) * 3)
+
+
+class Preprocessor:
+    """
+    Fused preprocessing of microwave volumes into a reused NCHW float32 batch
+    """
+
+    def __init__(self, img_size, stride=32, scale=INTENSITY_SCALE):
+        self.img_size = img_size
+        self.stride = stride
+        self.scale = scale
+        self._geometries = {}
+        self._batch = np.empty((0, 3, *img_size), dtype=np.float32)
+        self._slots = []  # geometry each slot of the batch has been padded for
+        self._scratch = threading.local()
+
+    def geometry(self, shape):
+        """
+        Letterbox geometry for the given input shape, computed once per shape.
+        :param shape: shape of the microwave volume
+        :return: Geometry
+        """
+        if shape not in self._geometries:
+            self._geometries[shape] = letterbox_geometry(shape, self.img_size, self.stride)
+        return self._geometries[shape]
+
+    def batch(self, img_arrays):
+        """
+        Preprocess microwave volumes into the preallocated batch. The returned array is overwritten by the next call.
+        :param img_arrays: list of microwave volumes with shape MxNx3
+        :return: float32 array with shape BxCxHxW and values between 0 and 1
+        """
+        if len(img_arrays) > len(self._batch):
+            self._batch = np.empty((len(img_arrays), 3, *self.img_size), dtype=np.float32)
+            self._slots = [None] * len(img_arrays)
+
+        for index, img_array in enumerate(img_arrays):
+            self.fill(index, img_array)
+
+        return self._batch[:len(img_arrays)]
+
+    def fill(self, index, img_array):
+        """
+        Write a preprocessed microwave volume into one slot of the batch.
+        :param index: slot of the batch
+        :param img_array: microwave volume with shape MxNx3
+        """
+        geometry = self.geometry(img_array.shape)
+        slot = self._batch[index]
+        if self._slots[index] != geometry:
+            slot.fill(np.float32(PAD_VALUE) / np.float32(255))
+            self._slots[index] = geometry
+
+        scaled, gray, gray_uint8, resized = self._buffers(img_array, geometry)
+        np.multiply(img_array, self.scale, out=scaled)
+        cv2.cvtColor(scaled, cv2.COLOR_BGR2GRAY, dst=gray)
+        np.clip(gray, 0, 255, out=gray)
+        np.copyto(gray_uint8, gray, casting='unsafe')
+        if resized is not gray_uint8:
+            cv2.resize(gray_uint8, geometry.resize, dst=resized, interpolation=cv2.INTER_LINEAR)
+
+        width, height = geometry.resize
+        plane = slot[0, geometry.top:geometry.top + height, geometry.left:geometry.left + width]
+        np.divide(resized, np.float32(255), out=plane, dtype=np.float32)
+        slot[1:, geometry.top:geometry.top + height, geometry.left:geometry.left + width] = plane
+
+    def _buffers(self, img_array, geometry):
+        """
+        Scratch buffers of the calling thread for the given input shape and dtype.
+        """
+        key = (img_array.shape, img_array.dtype)
+        buffers = getattr(self._scratch, 'buffers', None)
+        if buffers is None or buffers[0] != key:
+            height, width = img_array.shape[:2]
+            scaled = np.empty(img_array.shape, dtype=np.result_type(img_array, self.scale))
+            gray = np.empty((height, width), dtype=scaled.dtype)
+            gray_uint8 = np.empty((height, width), dtype=np.uint8)
+            if geometry.resize == (width, height):
+                resized = gray_uint8
+            else:
+                resized = np.empty(geometry.resize[::-1], dtype=np.uint8)
+            buffers = self._scratch.buffers = (key, (scaled, gray, gray_uint8, resized))
+        return buffers[1]
@@ -0,0 +1,118 @@
+"""
+Build the INT8 model used by OnnxBackend(precision='int8').
+
+The exported fp32 ONNX model is quantized either statically, calibrated on a folder of sample tiff files, or
+dynamically. The quantized model is only accepted if none of the scoring metrics anomaly_detection_accuracy,
+avg_sample_accuracy and distance evaluated on the labelled sample folder drops by more than max_drop compared to the
+fp32 model. Otherwise it is discarded and the previously accepted model is kept.
+
+Usage: python quantization.py calibration_dir [--method static|dynamic] [--max-drop 0.5]
+"""
+
+import os
+import glob
+import argparse
+import onnx
+from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic,
+                                      quantize_static)
+from backends import OnnxBackend, OnnxModel
+from detect_single import ROOT
+from evaluation import GATED_METRICS, evaluate
+from model import Model
+from preprocessing import Preprocessor
+
+
+class TiffCalibrationReader(CalibrationDataReader):
+    """
+    Feeds preprocessed sample tiff files to the static quantization
+    """
+
+    def __init__(self, calibration_dir, img_size, input_name='images'):
+        self.input_files = sorted(glob.glob(os.path.join(calibration_dir, '*.tiff')))
+        self.preprocessor = Preprocessor(img_size)
+        self.input_name = input_name
+        self.index = 0
+
+    def get_next(self):
+        """
+        Input of the next calibration sample or None if all samples have been used
+        """
+        if self.index >= len(self.input_files):
+            return None
+        img_array = Model.load_microwave_volume(self.input_files[self.index])
+        self.index += 1
+        return {self.input_name: self.preprocessor.batch([img_array]).copy()}
+
+    def rewind(self):
+        """
+        Start again with the first calibration sample
+        """
+        self.index = 0
+
+
+class _CandidateBackend(OnnxBackend):
+    """
+    ONNX backend which loads a quantized model which has not been accepted yet
+    """
+
+    def __init__(self, onnx_file):
+        super().__init__()
+        self.candidate = onnx_file
+
+    def load(self, weights, data, img_size):
+        del weights, data, img_size  # the candidate has been built from the exported model already
+        return OnnxModel(self.candidate, self.intra_op_threads, self.inter_op_threads)
+
+
+def quantize(calibration_dir, method='static', max_drop=0.5):
+    """
+    Quantize the exported ONNX model of the default weights to INT8 and accept it only if it passes the accuracy gate.
+    :param calibration_dir: directory with labelled sample tiff files
+    :param method: 'static' (calibrated on the samples) or 'dynamic' quantization
+    :param max_drop: maximum allowed drop of every gated metric in percentage points
+    :return: dictionary with the fp32 and int8 metrics and whether the quantized model was accepted
+    """
+    baseline = Model(backend=OnnxBackend())  # exports the fp32 model if necessary
+    img_size = baseline.model.img_size
+    fp32_file = OnnxBackend.onnx_file(ROOT / 'best.pt', img_size)
+    int8_file = OnnxBackend.onnx_file(ROOT / 'best.pt', img_size, 'int8')
+    candidate_file = int8_file.with_suffix('.candidate.onnx')
+
+    if method == 'static':
+        # only the convolutions are quantized, the box decoding of the detection head stays in fp32
+        quantize_static(str(fp32_file), str(candidate_file), TiffCalibrationReader(calibration_dir, img_size),
+                        quant_format=QuantFormat.QDQ, op_types_to_quantize=['Conv'],
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    else:
+        quantize_dynamic(str(fp32_file), str(candidate_file), weight_type=QuantType.QUInt8)
+
+    # keep stride and class names of the exported model
+    model_onnx = onnx.load(str(candidate_file))
+    del model_onnx.metadata_props[:]
+    model_onnx.metadata_props.extend(onnx.load(str(fp32_file)).metadata_props)
+    onnx.save(model_onnx, str(candidate_file))
+
+    report = {'fp32': evaluate(baseline, calibration_dir),
+              'int8': evaluate(Model(backend=_CandidateBackend(candidate_file)), calibration_dir)}
+    report['accepted'] = all(report['int8'][name] >= report['fp32'][name] - max_drop for name in GATED_METRICS)
+
+    if report['accepted']:
+        os.replace(candidate_file, int8_file)
+    else:
+        os.remove(candidate_file)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the INT8 model and validate it against the fp32 model')
+    parser.add_argument('calibration_dir', help='directory with labelled sample tiff files')
+    parser.add_argument('--method', choices=('static', 'dynamic'), default='static')
+    parser.add_argument('--max-drop', type=float, default=0.5,
+                        help='maximum allowed drop of every metric in percentage points (default: 0.5)')
+    args = parser.parse_args()
+
+    result = quantize(args.calibration_dir, method=args.method, max_drop=args.max_drop)
+    for metric in GATED_METRICS:
+        print(f"{metric:26}: fp32 {result['fp32'][metric]:>10.6f}  int8 {result['int8'][metric]:>10.6f}")
+    print('Quantized model accepted.' if result['accepted'] else 'Quantized model rejected, metric drop too large.')
@@ -0,0 +1,143 @@
+"""
+Compact container of the predictions of a data set.
+
+The file names, pill counts and pill coordinates of all predictions are stored in a few contiguous numpy arrays with an
+offsets index instead of one nested dictionary per image: every prediction costs its name, two counts and 16 bytes per
+pill. A plain prediction dictionary in the format of the scoring program is only built when it is accessed, so every
+element serializes with json.dumps. The container itself does not, list(results) gives a list of dictionaries.
+"""
+
+import os
+from collections.abc import Sequence
+import numpy as np
+
+
+def prediction_dict(file_path, detections):
+    """
+    Prediction dictionary of an image in the format of the scoring program.
+    :param file_path: path of the tiff file
+    :param detections: structured array of pills, see detect_single.DETECTION_DTYPE
+    :return: dictionary with the file name, the counts and the coordinates of the missing and present pills
+    """
+    present = detections['cls'] == 1
+    return {
+        'file': os.path.basename(file_path),
+        'missing_pills': int(np.count_nonzero(~present)),
+        'present_pills': int(np.count_nonzero(present)),
+        'coordinates': {pill_type: list(zip(detections['x'][mask].tolist(), detections['y'][mask].tolist()))
+                        for pill_type, mask in (('missing', ~present), ('present', present))},
+    }
+
+
+class _Buffer:
+    """
+    Growable numpy array, the capacity is doubled when it is full
+    """
+
+    __slots__ = ('data', 'size')
+
+    def __init__(self, dtype, width=None, capacity=1024):
+        self.data = np.empty((capacity,) if width is None else (capacity, width), dtype=dtype)
+        self.size = 0
+
+    def reserve(self, count):
+        """
+        Append count uninitialized rows
+        :return: writable view of the appended rows
+        """
+        end = self.size + count
+        if end > len(self.data):
+            grown = np.empty((max(end, 2 * len(self.data)),) + self.data.shape[1:], dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        rows = self.data[self.size:end]
+        self.size = end
+        return rows
+
+    def append(self, value):
+        """
+        Append a single row
+        """
+        self.reserve(1)[0] = value
+
+
+class PredictionResults(Sequence):
+    """
+    Sequence of predictions stored in contiguous arrays
+    """
+
+    def __init__(self):
+        self._names = _Buffer(np.uint8)  # utf-8 encoded file names of all predictions
+        self._name_ends = _Buffer(np.int64)  # end of the name of every prediction in _names
+        self._counts = _Buffer(np.int32, 2)  # present and missing pills of every prediction
+        self._coordinates = _Buffer(np.float64, 2)  # x, y of the present and then the missing pills of a prediction
+        self._pill_ends = _Buffer(np.int64)  # end of the pills of every prediction in _coordinates
+
+    def append(self, file_path, detections):
+        """
+        Append the prediction of an image.
+        :param file_path: path of the tiff file
+        :param detections: structured array of pills, see detect_single.DETECTION_DTYPE
+        """
+        present = detections['cls'] == 1
+        count = int(np.count_nonzero(present))
+        coordinates = self._add(os.path.basename(file_path), (count, len(detections) - count))
+        xy = np.stack((detections['x'], detections['y']), axis=1)
+        coordinates[:count] = xy[present]
+        coordinates[count:] = xy[~present]
+
+    def append_prediction(self, prediction):
+        """
+        Append a prediction dictionary, e.g. one received from the inference server
+        """
+        coordinates = prediction['coordinates']['present'] + prediction['coordinates']['missing']
+        self._add(prediction['file'], (prediction['present_pills'], prediction['missing_pills']))[:] = \
+            np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+
+    def _add(self, name, counts):
+        """
+        Append the name and the counts of a prediction
+        :return: writable view of the rows of its present and then its missing pills
+        """
+        name = name.encode('utf-8')
+        self._names.reserve(len(name))[:] = np.frombuffer(name, dtype=np.uint8)
+        self._name_ends.append(self._names.size)
+        self._counts.append(counts)
+        coordinates = self._coordinates.reserve(counts[0] + counts[1])
+        self._pill_ends.append(self._coordinates.size)
+        return coordinates
+
+    def __len__(self):
+        return self._counts.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.prediction(i) for i in range(*index.indices(len(self)))]
+        if not -len(self) <= index < len(self):
+            raise IndexError(f"Prediction index {index} out of range")
+        return self.prediction(index % len(self))
+
+    def prediction(self, index):
+        """
+        Prediction dictionary of a prediction, built from the arrays
+        :param index: index of the prediction
+        :return: new dictionary with the file name, the counts and the coordinates of the missing and present pills
+        """
+        name_start = self._name_ends.data[index - 1] if index else 0
+        start = self._pill_ends.data[index - 1] if index else 0
+        split = start + self._counts.data[index, 0]
+        return {
+            'file': self._names.data[name_start:self._name_ends.data[index]].tobytes().decode('utf-8'),
+            'missing_pills': int(self._counts.data[index, 1]),
+            'present_pills': int(self._counts.data[index, 0]),
+            'coordinates': {
+                'missing': [tuple(xy) for xy in self._coordinates.data[split:self._pill_ends.data[index]].tolist()],
+                'present': [tuple(xy) for xy in self._coordinates.data[start:split].tolist()]},
+        }
+
+    def nbytes(self):
+        """
+        Bytes allocated by the arrays
+        """
+        return sum(buffer.data.nbytes for buffer in (self._names, self._name_ends, self._counts, self._coordinates,
+                                                     self._pill_ends))
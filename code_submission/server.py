@@ -0,0 +1,273 @@
+"""
+Persistent local inference server which keeps a warmed Model in memory.
+
+The server accepts JSON lines over a Unix socket or a local TCP port. Every request names one tiff file,
+{"id": 7, "file": "/data/image_0007.tiff"}, and is answered with {"id": 7, "prediction": {...}} in the format of
+Model.predict, or {"id": 7, "error": "..."}. Requests which arrive concurrently, from one or many clients, are coalesced
+into micro-batches of at most --max-batch-size files, waiting at most --max-wait seconds for a batch to fill up. Model
+loading and warmup are paid once when the server starts instead of once per evaluation run.
+
+Usage: python server.py [--socket /tmp/detector.sock | --port 8765] [--max-batch-size 16] [--max-wait 0.005]
+                        [--cache predictions.sqlite]
+
+Model becomes a thin client of a running server if the environment variable DETECTOR_SERVER is set to its socket path
+or host:port, e.g. DETECTOR_SERVER=/tmp/detector.sock.
+"""
+
+import os
+import json
+import socket
+import asyncio
+import argparse
+import importlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+import cv2
+from instrumentation import StageTimer
+
+DEFAULT_SOCKET = '/tmp/detector.sock'
+MAX_IN_FLIGHT = 256  # unanswered requests per connection before the server stops reading from it
+# errors of a single request which are answered with an error response instead of ending the server: unreadable or
+# corrupt tiff files (OSError, ValueError, cv2.error), volumes the detector cannot run (RuntimeError) and malformed
+# request lines (json.JSONDecodeError, KeyError)
+REQUEST_ERRORS = (OSError, ValueError, KeyError, json.JSONDecodeError, cv2.error, RuntimeError)
+
+
+def parse_address(address):
+    """
+    Parse a server address.
+    :param address: path of a Unix socket or host:port of a TCP socket
+    :return: ('tcp', (host, port)) or ('unix', path)
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return 'tcp', (host, int(port))
+    return 'unix', address
+
+
+class InferenceServer:
+    """
+    Micro-batching server around a Model
+    """
+
+    def __init__(self, model, max_batch_size=16, max_wait=0.005):
+        """
+        :param model: Model which predicts the micro-batches
+        :param max_batch_size: maximum number of files per micro-batch
+        :param max_wait: maximum seconds the first request of a micro-batch waits for further requests
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None  # (file path, future) of the pending requests, created in the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1)  # one micro-batch at a time, outside of the event loop
+
+    async def serve(self, address):
+        """
+        Serve requests until the process is terminated.
+        :param address: path of a Unix socket or host:port
+        """
+        self._queue = asyncio.Queue()
+        kind, location = parse_address(address)
+        if kind == 'tcp':
+            server = await asyncio.start_server(self._handle, *location)
+        else:
+            if os.path.exists(location):
+                os.remove(location)  # stale socket of a previous server
+            server = await asyncio.start_unix_server(self._handle, location)
+        print(f"Serving on {address}, max batch size {self.max_batch_size:d}, max wait {self.max_wait:g} s")
+        async with server:
+            await asyncio.gather(server.serve_forever(), self._batches())
+
+    async def submit(self, file_path):
+        """
+        Queue a file for the next micro-batch.
+        :param file_path: path of the tiff file
+        :return: prediction dictionary
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((file_path, future))
+        return await future
+
+    async def _batches(self):
+        """
+        Coalesce the queued requests into micro-batches and predict them
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._predict_batch(batch)
+
+    async def _predict_batch(self, batch):
+        """
+        Predict a micro-batch of (file path, future) in the executor thread and resolve the futures
+        """
+        try:
+            predictions = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._predict, [file_path for file_path, _ in batch])
+        except REQUEST_ERRORS as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+            else:
+                for request in batch:  # isolate the failing file, the others are still answered
+                    await self._predict_batch([request])
+            return
+        for (_, future), prediction in zip(batch, predictions):
+            future.set_result(prediction)
+
+    def _predict(self, file_paths):
+        """
+        Predict one micro-batch in the executor thread
+        """
+        return list(self.model.predict_files(file_paths))
+
+    async def _handle(self, reader, writer):
+        """
+        Answer the requests of one connection, the requests are processed concurrently
+        """
+        in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+        async def respond(line):
+            request = {}
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict) or not isinstance(request.get('file'), str):
+                    raise ValueError('The request is not a JSON object with the path of a tiff file')
+                response = {'id': request.get('id'), 'prediction': await self.submit(request['file'])}
+            except REQUEST_ERRORS as error:
+                request_id = request.get('id') if isinstance(request, dict) else None
+                response = {'id': request_id, 'error': f"{type(error).__name__}: {error}"}
+            writer.write((json.dumps(response) + '\n').encode())
+            in_flight.release()
+
+        tasks = set()
+        while line := await reader.readline():
+            await in_flight.acquire()
+            task = asyncio.ensure_future(respond(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            await writer.drain()
+        await asyncio.gather(*tasks)
+        await writer.drain()
+        writer.close()
+
+
+class InferenceClient:
+    """
+    Thin client which sends tiff files to a running InferenceServer
+    """
+
+    def __init__(self, address, window=64):
+        """
+        :param address: path of the Unix socket or host:port of the server
+        :param window: maximum number of unanswered requests
+        """
+        self.address = address
+        self.window = window
+        self.timer = StageTimer()  # round trip latency of every request
+        tic = default_timer()
+        kind, location = parse_address(address)
+        self._socket = socket.create_connection(location) if kind == 'tcp' \
+            else socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if kind == 'unix':
+            self._socket.connect(location)
+        self._reader = self._socket.makefile('rb')
+        self.startup = {'connect': default_timer() - tic}
+
+    def predict_files(self, input_files):
+        """
+        Generator which yields the prediction of every given tiff file in the order the server answers.
+        :param input_files: paths of the tiff files, which have to be readable by the server
+        :return: generator of prediction dictionaries
+        """
+        input_files = list(input_files)
+        sent = {}  # send time of the unanswered requests
+        window = queue.Queue(maxsize=self.window)  # ids of the unanswered requests
+        stop = threading.Event()
+
+        def send():
+            for index, file_path in enumerate(input_files):
+                window.put(index)
+                if stop.is_set():
+                    return
+                sent[index] = default_timer()
+                request = {'id': index, 'file': os.path.abspath(file_path)}
+                self._socket.sendall((json.dumps(request) + '\n').encode())
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        error = None
+        try:
+            for _ in input_files:
+                response = self._receive()
+                window.get()
+                self.timer.record('request', default_timer() - sent.pop(response['id']))
+                if 'error' in response:
+                    error = error or f"Inference server failed on {input_files[response['id']]}: {response['error']}"
+                elif error is None:
+                    yield response['prediction']
+        finally:
+            # a caller which stops iterating early leaves requests in flight, their responses are read such that the
+            # connection can be reused
+            stop.set()
+            while sender.is_alive():
+                try:
+                    window.get(timeout=0.01)  # a sender waiting for a free slot returns without sending
+                except queue.Empty:
+                    pass
+            while sent:
+                sent.pop(self._receive()['id'], None)
+        if error is not None:  # raised after all responses were read, such that the connection can be reused
+            raise RuntimeError(error)
+
+    def _receive(self):
+        """
+        Read the next response
+        """
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError(f"Inference server {self.address} closed the connection")
+        return json.loads(line)
+
+    def close(self):
+        """
+        Close the connection
+        """
+        self._reader.close()
+        self._socket.close()
+
+
+def main():
+    """
+    Command line interface
+    """
+    parser = argparse.ArgumentParser(description='Persistent inference server with micro-batching')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='path of the Unix socket')
+    parser.add_argument('--port', type=int, help='serve on 127.0.0.1:PORT instead of the Unix socket')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='maximum number of files per micro-batch')
+    parser.add_argument('--max-wait', type=float, default=0.005,
+                        help='maximum seconds a request waits for the micro-batch to fill up')
+    parser.add_argument('--cache', help='path of a persistent prediction cache, see Model.use_cache')
+    config = parser.parse_args()
+
+    os.environ.pop('DETECTOR_SERVER', None)  # the server runs the model itself
+    model = importlib.import_module('model').Model(batch_size=config.max_batch_size)
+    if config.cache:
+        model.use_cache(config.cache)
+    print("Startup: " + ", ".join(f"{step} {seconds:.3g} s" for step, seconds in model.startup.items()))
+
+    address = f'127.0.0.1:{config.port:d}' if config.port else config.socket
+    asyncio.run(InferenceServer(model, config.max_batch_size, config.max_wait).serve(address))
+
+
+if __name__ == '__main__':
+    main()
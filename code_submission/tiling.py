@@ -0,0 +1,143 @@
+"""
+Tiled inference on microwave volumes which are larger than the volumes the detector has been trained on.
+
+A large scene is split into overlapping tiles of the training size, which keeps small pills at the scale the detector
+has learned instead of downscaling the whole scene to the inference size. The tiles are batched through the fused
+preprocessing and the detector and the detections are mapped back to the full frame. Detections touching an inner tile
+border are cut by the tile and dropped, the neighbouring tile sees the complete pill because the overlap is larger than
+a pill. The remaining duplicates within the overlaps are merged with a global class-aware non maximum suppression.
+
+Only the volume, which may also be a memory map, and one batch of tiles are held in memory, independent of the size of
+the scene.
+"""
+
+import importlib
+import numpy as np
+from torch import from_numpy
+from detect_single import DETECTION_DTYPE
+
+TILE_SIZE = 257  # size of the training volumes
+TILE_OVERLAP = 64  # must be larger than the largest pill
+EDGE_MARGIN = 1  # distance in pixels below which a detection touches a tile border
+
+
+def tile_origins(length, tile_size, overlap):
+    """
+    Start positions of overlapping tiles which cover an axis, the last tile is aligned with the end of the axis.
+    :param length: length of the axis
+    :param tile_size: length of a tile
+    :param overlap: minimum overlap of neighbouring tiles
+    :return: list of start positions
+    """
+    if length <= tile_size:
+        return [0]
+    return list(range(0, length - tile_size, tile_size - overlap)) + [length - tile_size]
+
+
+class TiledDetector:
+    """
+    Detect pills on scenes of any size by running a Detector on overlapping tiles
+    """
+
+    def __init__(self, detector, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+        """
+        :param detector: Detector which runs the tiles
+        :param tile_size: edge length of the square tiles in pixels
+        :param overlap: minimum overlap of neighbouring tiles in pixels, must be larger than a pill
+        """
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"The overlap must be between 0 and the tile size {tile_size}, got {overlap}")
+        self.detector = detector
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+    def fits(self, shape):
+        """
+        Whether a volume fits into a single tile and can be detected directly
+        :param shape: shape of the volume
+        """
+        return shape[0] <= self.tile_size and shape[1] <= self.tile_size
+
+    def tiles(self, shape):
+        """
+        Origins of the tiles of a scene
+        :param shape: shape of the volume
+        :return: list of (top, left) pixel positions
+        """
+        return [(top, left) for top in tile_origins(shape[0], self.tile_size, self.overlap)
+                for left in tile_origins(shape[1], self.tile_size, self.overlap)]
+
+    def detect(self, volume, batch_size=16, conf_thres=0.67, iou_thres=0.45):
+        """
+        Detect pills on a scene of any size.
+        :param volume: microwave volume with shape MxNx3, a numpy array or memory map
+        :param batch_size: maximum number of tiles per forward pass
+        :param conf_thres: confidence threshold
+        :param iou_thres: IOU threshold of the detector and of the merge across tiles
+        :return: structured array of pills in the full frame, in the same format as Detector.detect
+        """
+        origins = self.tiles(volume.shape)
+        detections = []
+        for start in range(0, len(origins), batch_size):
+            detections.extend(self._detect_tiles(volume, origins[start:start + batch_size], conf_thres, iou_thres))
+        boxes, scores, classes = (np.concatenate(parts) for parts in zip(*detections))
+
+        with self.detector.timer.stage('merge'):
+            return self._merge(boxes, scores, classes, volume.shape[0], iou_thres)
+
+    def _detect_tiles(self, volume, origins, conf_thres, iou_thres):
+        """
+        Detect pills on one batch of tiles
+        :return: list with the boxes (x1, y1, x2, y2) in the full frame with y measured from the top, the confidences
+                 and the classes of every tile, without the detections which are cut by an inner tile border
+        """
+        tiles = [np.asarray(volume[top:top + self.tile_size, left:left + self.tile_size]) for top, left in origins]
+        detections = []
+        for (top, left), tile, pills in zip(origins, tiles,
+                                            self.detector.detect_volumes(tiles, len(tiles), conf_thres, iou_thres)):
+            boxes = self._boxes(pills, tile.shape)
+            kept = ~self._touches_inner_border(boxes, (top, left), tile.shape, volume.shape)
+            detections.append((boxes[kept] + np.array([left, top, left, top], dtype=np.float64),
+                               pills['conf'][kept], pills['cls'][kept]))
+        return detections
+
+    @staticmethod
+    def _boxes(pills, tile_shape):
+        """
+        Corner boxes (x1, y1, x2, y2) of the pills of a tile with y measured from the top of the tile
+        """
+        y = tile_shape[0] - pills['y']
+        return np.stack([pills['x'] - pills['w'] / 2, y - pills['h'] / 2,
+                         pills['x'] + pills['w'] / 2, y + pills['h'] / 2], axis=1).reshape(-1, 4)
+
+    @staticmethod
+    def _touches_inner_border(boxes, origin, tile_shape, scene_shape):
+        """
+        Mask of the boxes which touch a tile border which is not a border of the scene
+        """
+        top, left = origin
+        tile_height, tile_width = tile_shape[:2]
+        return (((boxes[:, 0] <= EDGE_MARGIN) & (left > 0))
+                | ((boxes[:, 1] <= EDGE_MARGIN) & (top > 0))
+                | ((boxes[:, 2] >= tile_width - EDGE_MARGIN) & (left + tile_width < scene_shape[1]))
+                | ((boxes[:, 3] >= tile_height - EDGE_MARGIN) & (top + tile_height < scene_shape[0])))
+
+    @staticmethod
+    def _merge(boxes, scores, classes, height, iou_thres):
+        """
+        Class-aware non maximum suppression across all tiles and conversion into a structured array of pills
+        """
+        batched_nms = importlib.import_module('torchvision.ops').batched_nms
+        # the nms kernel requires boxes and scores of the same dtype
+        keep = batched_nms(from_numpy(boxes.astype(np.float32)), from_numpy(scores.astype(np.float32)),
+                           from_numpy(classes.astype(np.int64)), iou_thres).numpy()
+        keep = keep[::-1]  # ascending confidence like Detector.detect
+
+        pills = np.empty(len(keep), dtype=DETECTION_DTYPE)
+        pills['cls'] = classes[keep]
+        pills['x'] = (boxes[keep, 0] + boxes[keep, 2]) / 2
+        pills['y'] = height - (boxes[keep, 1] + boxes[keep, 3]) / 2
+        pills['w'] = boxes[keep, 2] - boxes[keep, 0]
+        pills['h'] = boxes[keep, 3] - boxes[keep, 1]
+        pills['conf'] = scores[keep]
+        return pills
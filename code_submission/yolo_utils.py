@@ -0,0 +1,97 @@
+"""
+The box helpers of yolov5 (6.1) which the detector needs at inference time.
+
+They are copied from yolov5.utils.general, which imports yolov5.utils.metrics and with it matplotlib, pandas and
+torchvision when it is imported. Keeping them here means the fast-start backends (a cached TorchScript or ONNX model)
+never import the yolov5 package. torchvision is imported on the first non maximum suppression.
+"""
+
+import math
+import importlib
+from torch import cat, zeros
+
+
+def check_img_size(img_size, s=32, floor=0):
+    """
+    Round the inference size up to a multiple of the model stride
+    :param img_size: inference size, an int or (height, width)
+    :param s: model stride
+    :param floor: minimum size
+    :return: int or list like img_size
+    """
+    if isinstance(img_size, int):
+        return max(math.ceil(img_size / int(s)) * int(s), floor)
+    return [max(math.ceil(size / int(s)) * int(s), floor) for size in img_size]
+
+
+def xywh2xyxy(x):
+    """
+    Convert nx4 boxes from center, width and height to corners
+    """
+    y = x.clone()
+    y[:, 0] = x[:, 0] - x[:, 2] / 2
+    y[:, 1] = x[:, 1] - x[:, 3] / 2
+    y[:, 2] = x[:, 0] + x[:, 2] / 2
+    y[:, 3] = x[:, 1] + x[:, 3] / 2
+    return y
+
+
+def xyxy2xywh(x):
+    """
+    Convert nx4 boxes from corners to center, width and height
+    """
+    y = x.clone()
+    y[:, 0] = (x[:, 0] + x[:, 2]) / 2
+    y[:, 1] = (x[:, 1] + x[:, 3]) / 2
+    y[:, 2] = x[:, 2] - x[:, 0]
+    y[:, 3] = x[:, 3] - x[:, 1]
+    return y
+
+
+def scale_coords(img1_shape, coords, img0_shape):
+    """
+    Rescale corner boxes in place from the letterboxed network input to the original image and clip them to it
+    :param img1_shape: shape of the network input
+    :param coords: nx4 tensor of corner boxes
+    :param img0_shape: shape of the original image
+    :return: coords
+    """
+    gain = min(img1_shape[0] / img0_shape[0], img1_shape[1] / img0_shape[1])
+    pad = (img1_shape[1] - img0_shape[1] * gain) / 2, (img1_shape[0] - img0_shape[0] * gain) / 2
+    coords[:, [0, 2]] -= pad[0]
+    coords[:, [1, 3]] -= pad[1]
+    coords[:, :4] /= gain
+    coords[:, [0, 2]] = coords[:, [0, 2]].clamp(0, img0_shape[1])
+    coords[:, [1, 3]] = coords[:, [1, 3]].clamp(0, img0_shape[0])
+    return coords
+
+
+def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, max_det=300):
+    """
+    Class-aware non maximum suppression of raw yolov5 predictions with a single label per box, like the default of
+    yolov5's non_max_suppression
+    :param prediction: tensor with shape BxNx(5 + classes)
+    :param conf_thres: confidence threshold
+    :param iou_thres: IOU threshold
+    :param max_det: maximum number of detections per image
+    :return: list with one nx6 tensor (x1, y1, x2, y2, conf, cls) per image
+    """
+    nms = importlib.import_module('torchvision.ops').nms
+    max_wh = 7680  # offset of the boxes of different classes
+    max_nms = 30000  # maximum number of boxes into nms
+    candidates = prediction[..., 4] > conf_thres
+    output = [zeros((0, 6), device=prediction.device)] * prediction.shape[0]
+    for index, x in enumerate(prediction):
+        x = x[candidates[index]]
+        if not x.shape[0]:
+            continue
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        x = cat((xywh2xyxy(x[:, :4]), conf, j.float()), 1)[conf.view(-1) > conf_thres]
+        if not x.shape[0]:
+            continue
+        if x.shape[0] > max_nms:
+            x = x[x[:, 4].argsort(descending=True)[:max_nms]]
+        keep = nms(x[:, :4] + x[:, 5:6] * max_wh, x[:, 4], iou_thres)[:max_det]
+        output[index] = x[keep]
+    return output
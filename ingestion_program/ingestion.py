@@ -30,6 +30,41 @@ DEFAULT_HIDDEN_DIR = r'E:\measurements\engineering_competition\dataset_final\dop
 DEFAULT_PROGRAM_DIR = ROOT_DIR + "ingestion_program"
 DEFAULT_SUBMISSION_DIR = ROOT_DIR + "test-submission"
 
+# Prediction cache
+# Path of a persistent cache of the detections of unchanged tiff files, used if the model supports it.
+# None disables the cache.
+PREDICTION_CACHE = None
+PREDICTION_CACHE_SIZE = 1000000  # maximum number of cached files
+
+# Pylint cache
+# Path of a file with the pylint ratings of previously linted submissions, keyed by a hash of the linted sources and
+# the pylint arguments. Unchanged submissions are not linted again. None disables the cache.
+PYLINT_CACHE = ROOT_DIR + "pylint_cache.json"
+
+# Number of worker processes, each with its own model, predicting interleaved shards of the tiff files.
+# Can be overridden with --workers N. Sharding requires a model with a predict_files method.
+# None uses the number of processes of the inference profile of the submission (see autotune.py) or 1.
+WORKERS = None
+
+# Fast start: skip the GPU listing, which imports tensorflow, and let models which support it load their pre-fused
+# TorchScript artifact (DETECTOR_BACKEND=torchscript) instead of rebuilding the network from the weights.
+# Can be enabled with --fast-start.
+FAST_START = False
+
+# Bulk output: write all predictions into one JSON Lines file (predictions.jsonl with an index by file name) instead
+# of one .prediction file per image. The scoring program reads either layout. Can be enabled with --bulk.
+BULK_OUTPUT = False
+
+# Watch mode: keep one model resident, watch the hidden dir for new tiff files and write their predictions as soon as
+# they are complete, until no new file arrived for WATCH_IDLE_TIMEOUT seconds (None: until interrupted). Processed
+# files are recorded in a checkpoint in the output dir, so a restarted watch skips them. Files which cannot be predicted,
+# e.g. corrupt tiff files, are recorded there with their error and counted in watch_metrics.json, the watch goes on.
+# Can be enabled with --watch.
+WATCH = False
+WATCH_SETTLE_TIME = 1.0  # seconds a new file must stay unchanged before it is considered complete
+WATCH_POLL_INTERVAL = 0.2  # seconds between two scans of the directory while it is idle
+WATCH_IDLE_TIMEOUT = None
+
 # =============================================================================
 # =========================== END USER OPTIONS ================================
 # =============================================================================
@@ -37,14 +72,35 @@ DEFAULT_SUBMISSION_DIR = ROOT_DIR + "test-submission"
 
 if __name__ == "__main__":
     import os
-    from sys import argv, path
+    import argparse
+    import functools
+    import importlib
+    from sys import path
     import json
     import timeit
-    import tensorflow.config
     import tools.helpers
+    import tools.sharding
+    import tools.watch
 
     print('Ingestion program started.')
 
+    parser = argparse.ArgumentParser(description='Ingestion program')
+    parser.add_argument('dirs', nargs='*', metavar='dir',
+                        help='input_dir output_dir hidden_dir ingestion_program_dir submission_program_dir')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='number of worker processes')
+    parser.add_argument('--fast-start', action='store_true', default=FAST_START,
+                        help='skip the GPU listing and load pre-fused model artifacts')
+    parser.add_argument('--bulk', action='store_true', default=BULK_OUTPUT,
+                        help=f'write all predictions into {tools.helpers.BULK_PREDICTIONS} instead of one file each')
+    parser.add_argument('--profile', choices=('torch', 'cprofile'),
+                        help='write a torch profiler or cProfile trace of the first forward passes to the output dir')
+    parser.add_argument('--watch', action='store_true', default=WATCH,
+                        help='continuously predict the tiff files which arrive in the hidden dir')
+    args = parser.parse_args()
+    if args.watch and args.bulk:
+        parser.error('--watch writes every prediction as soon as it is available and cannot be combined with --bulk')
+    argv = [parser.prog] + args.dirs
+
     # INPUT/OUTPUT: Get input and output directory names
     if len(argv) == 1:  # Use the default input and output directories if no arguments are provided
         INPUT_DIR = DEFAULT_INPUT_DIR
@@ -65,40 +121,154 @@ if __name__ == "__main__":
         print(f"Using program_dir: {PROGRAM_DIR}")
         print(f"Using submission_dir: {SUBMISSION_DIR}")
 
+    if VERBOSE and not args.fast_start:
+        import tensorflow.config  # slow to import, only needed for the GPU listing
         print(f"Available GPU(s): {tensorflow.config.list_physical_devices('GPU')}\n")
 
+    if args.fast_start:
+        os.environ.setdefault('DETECTOR_BACKEND', 'torchscript')  # also inherited by the worker processes
+
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
     # Our libraries
     path.append(PROGRAM_DIR)
     path.append(SUBMISSION_DIR)
 
+    # The code quality check runs in a background process while the model is created and predicts
+    pylint_job = tools.helpers.BackgroundPylint(os.path.join(SUBMISSION_DIR, 'model.py'),
+                                                os.path.abspath(PYLINT_CACHE) if PYLINT_CACHE is not None else None)
+
+    if args.workers is None:  # the number of processes which the submission has been tuned for on this machine
+        try:
+            profile = importlib.import_module('inference_profile').load_profile()
+        except ImportError:
+            profile = None
+        args.workers = (profile or {}).get('processes', 1)
+
     metrics = dict()
-    metrics['pylint_rating'] = tools.helpers.run_pylint(os.path.join(SUBMISSION_DIR, 'model.py'), verbose=True)
     metrics['prediction_time'] = 0
 
-    from model import Model  # example model
+    prediction_count = 0
+    dataset_dirs = [HIDDEN_DIR]  # INPUT_DIR,
+    cache = (PREDICTION_CACHE, PREDICTION_CACHE_SIZE) if PREDICTION_CACHE is not None else None
+
+    if args.bulk:
+        bulk_writer = tools.helpers.BulkPredictionWriter(os.path.join(OUTPUT_DIR, tools.helpers.BULK_PREDICTIONS))
+        write_prediction = bulk_writer.write
+    else:
+        bulk_writer = None
+        write_prediction = functools.partial(tools.helpers.write_prediction, OUTPUT_DIR)
+        # the scoring program prefers bulk predictions, the ones of a previous run must not shadow the new files
+        bulk_file = os.path.join(OUTPUT_DIR, tools.helpers.BULK_PREDICTIONS)
+        for stale_file in (f"{bulk_file}.index", bulk_file):
+            if os.path.exists(stale_file):
+                os.remove(stale_file)
+
+    if args.watch:
+        # A single resident model predicts the new files of the hidden dir in small batches
+        tic = timeit.default_timer()
+        from model import Model
+        metrics['startup'] = {'imports': timeit.default_timer() - tic}
+        tic = timeit.default_timer()
+        M = Model()
+        metrics['startup']['model'] = timeit.default_timer() - tic
+        metrics['startup'].update(getattr(M, 'startup', {}))
+        print("Startup: " + ", ".join(f"{step} {seconds:.3g} s" for step, seconds in metrics['startup'].items()))
+        if not hasattr(M, 'predict_files'):
+            raise TypeError('Watch mode requires a model with a predict_files method')
+        if cache is not None and hasattr(M, 'use_cache'):
+            M.use_cache(*cache)
 
-    # Create a model
-    print("Creating model instance")
-    M = Model()
+        watcher = tools.watch.FolderWatcher(HIDDEN_DIR, os.path.join(OUTPUT_DIR, tools.watch.CHECKPOINT_FILE),
+                                            WATCH_SETTLE_TIME)
+        monitor = tools.watch.LatencyMonitor(os.path.join(OUTPUT_DIR, tools.watch.METRICS_FILE))
+        print(f"Watching {HIDDEN_DIR}, {len(watcher.processed):d} files were processed before")
+        metrics['prediction_time'] = tools.watch.watch(M, watcher, monitor, write_prediction, {
+            'batch_size': getattr(M, 'batch_size', 16), 'poll_interval': WATCH_POLL_INTERVAL,
+            'idle_timeout': WATCH_IDLE_TIMEOUT})
+        prediction_count = monitor.files
+        metrics['watch'] = monitor.summary()
+    elif args.workers > 1:
+        # Every worker process creates its own model and predicts a shard of the files
+        input_files = sorted(file_path for dataset_dir in dataset_dirs
+                             for file_path in tools.sharding.input_files(dataset_dir))
+        print(f"Predicting {len(input_files):d} files with {args.workers:d} worker processes")
+        sharded = tools.sharding.ShardedIngestion(SUBMISSION_DIR, input_files, args.workers, cache)
 
-    prediction_time = 0
+        for prediction in sharded.predictions():
+            write_prediction(prediction)
+            prediction_count += 1
 
-    # Iterate through data set(s)
-    dataset_dirs = [HIDDEN_DIR]  # INPUT_DIR,
-    for dataset_dir in dataset_dirs:
+        metrics.update(sharded.metrics())
+        for worker_id, worker_metrics in enumerate(metrics['workers']):
+            print(f"Worker {worker_id:d}: {worker_metrics['files']:d} predictions, "
+                  f"{worker_metrics['images_per_second']:.3g} images/s")
+    else:
+        tic = timeit.default_timer()
+        from model import Model  # example model
+        metrics['startup'] = {'imports': timeit.default_timer() - tic}
+
+        # Create a model
+        print("Creating model instance")
         tic = timeit.default_timer()
-        predictions = M.predict(dataset_dir)
-        metrics['prediction_time'] += timeit.default_timer() - tic
+        M = Model()
+        metrics['startup']['model'] = timeit.default_timer() - tic
+        metrics['startup'].update(getattr(M, 'startup', {}))  # e.g. weight_load and warmup
+        print("Startup: " + ", ".join(f"{step} {seconds:.3g} s" for step, seconds in metrics['startup'].items()))
+
+        # Models with built-in instrumentation report per-stage latencies, the writing of the files is added here
+        timer = getattr(M, 'timer', None)
+        if args.profile is not None and hasattr(M.model, 'profile_forward'):
+            trace_file = 'forward_trace.json' if args.profile == 'torch' else 'forward.prof'
+            M.model.profile_forward(args.profile, os.path.join(OUTPUT_DIR, trace_file))
+        if cache is not None and hasattr(M, 'use_cache'):
+            M.use_cache(*cache)
+
+        # Iterate through data set(s)
+        for dataset_dir in dataset_dirs:
+            # Models providing predict_iter are consumed as a stream, such that every prediction is written as soon as
+            # it is available. Only the time spent inside the model counts as prediction time.
+            if hasattr(M, 'predict_iter'):
+                predictions = M.predict_iter(dataset_dir)
+            else:
+                tic = timeit.default_timer()
+                predictions = M.predict(dataset_dir)
+                metrics['prediction_time'] += timeit.default_timer() - tic
+            predictions = iter(predictions)
+
+            while True:
+                tic = timeit.default_timer()
+                prediction = next(predictions, None)
+                metrics['prediction_time'] += timeit.default_timer() - tic
+                if prediction is None:
+                    break
+
+                tic = timeit.default_timer()
+                write_prediction(prediction)
+                if timer is not None:
+                    timer.record('write', timeit.default_timer() - tic)
+                prediction_count += 1
+
+        if timer is not None:
+            metrics['stages'] = timer.summary()
+        if getattr(M, 'cache', None) is not None:
+            metrics['prediction_cache'] = M.cache.stats()
+
+    if bulk_writer is not None:
+        bulk_writer.close()
 
-        for prediction in predictions:
-            prediction_file = os.path.join(OUTPUT_DIR, f"{os.path.splitext(prediction['file'])[0]}.prediction")
-            # print(f"Writing file {os.path.relpath(prediction_file)}")
-            with open(prediction_file, 'w') as prediction_file:
-                prediction_file.write(json.dumps(prediction))
+    print(f"Performed {prediction_count:d} predictions in {metrics['prediction_time']:.3g} s")
+    for stage, stage_metrics in metrics.get('stages', {}).items():
+        print(f"  {stage:12}: {stage_metrics['images_per_second']:10.1f} images/s, "
+              f"p50 {1000 * stage_metrics['p50']:.3g} ms, p95 {1000 * stage_metrics['p95']:.3g} ms, "
+              f"p99 {1000 * stage_metrics['p99']:.3g} ms")
+    if 'prediction_cache' in metrics:
+        print(f"Prediction cache: {metrics['prediction_cache']['hits']:d} hits, "
+              f"{metrics['prediction_cache']['misses']:d} misses")
 
-    print(f"Performed {len(predictions):d} predictions in {metrics['prediction_time']:.3g} s")
+    tic = timeit.default_timer()
+    metrics['pylint_rating'] = pylint_job.rating(verbose=True)
+    print(f"Waited {timeit.default_timer() - tic:.3g} s for the code quality check")
 
     with open(os.path.join(OUTPUT_DIR, 'ingestion_metrics.json'), 'w') as metric_file:
         metric_file.write(json.dumps(metrics))
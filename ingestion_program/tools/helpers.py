@@ -1,8 +1,17 @@
 import os
+import json
+import hashlib
+import multiprocessing
+import pylint
 from pylint import lint
 from pylint.reporters.text import TextReporter
 import re
 
+PYLINT_WHITELIST = 'numpy,torch,cv2'
+PYLINT_ARGS = ['--max-line-length=120', '--disable=invalid-name', f'--extension-pkg-whitelist={PYLINT_WHITELIST}',
+               f'--ignored-modules={PYLINT_WHITELIST}', f'--ignored-classes={PYLINT_WHITELIST}']
+PYLINT_CACHE_SIZE = 100  # maximum number of cached ratings
+
 
 class WritableObject():
     """ Dummy output stream for pylint """
@@ -18,11 +27,52 @@ class WritableObject():
         return self.content
 
 
-def run_pylint(filename, verbose=False):
-    """ Run pylint on the given file """
-    package_whitelist = 'numpy,torch,cv2'
-    pylint_args = ['--max-line-length=120', '--disable=invalid-name', f'--extension-pkg-whitelist={package_whitelist}',
-                   f'--ignored-modules={package_whitelist}', f'--ignored-classes={package_whitelist}']
+def pylint_key(filename, pylint_args=PYLINT_ARGS):
+    """ Hash of the pylint version and arguments and of all Python files in the directory of the given file """
+    directory = os.path.dirname(os.path.abspath(filename))
+    digest = hashlib.sha256(json.dumps([pylint.__version__, pylint_args, os.path.basename(filename)]).encode())
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.py'):
+                digest.update(os.path.relpath(os.path.join(root, name), directory).encode() + b'\0')
+                with open(os.path.join(root, name), 'rb') as file:
+                    digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+
+def _read_pylint_cache(cache_file):
+    """ Cached ratings and reports by pylint_key """
+    try:
+        with open(cache_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_pylint_cache(cache_file, key, entry):
+    """ Add a rating to the cache, the oldest entries are dropped """
+    cache = _read_pylint_cache(cache_file)
+    cache.pop(key, None)
+    cache[key] = entry
+    cache = dict(list(cache.items())[-PYLINT_CACHE_SIZE:])
+    try:
+        with open(f"{cache_file}.{os.getpid()}", 'w') as file:
+            file.write(json.dumps(cache))
+        os.replace(f"{cache_file}.{os.getpid()}", cache_file)  # atomic, concurrent ingestions may share the cache
+    except OSError as error:
+        print(f"Could not write the pylint cache {cache_file}: {error}")
+
+
+def check_code_quality(filename, cache_file=None):
+    """ Run pylint on the directory of the given file, returns the rating and the pylint report """
+    key = pylint_key(filename) if cache_file is not None else None
+    if key is not None:
+        entry = _read_pylint_cache(cache_file).get(key)
+        if entry is not None:
+            print("Checking Python code quality (unchanged sources, cached rating)")
+            return entry['rating'], entry['report']
+
     pylint_output = WritableObject()
 
     print("Checking Python code quality")
@@ -36,16 +86,17 @@ def run_pylint(filename, verbose=False):
             open(init_file, 'w').close()
             init_files.append(init_file)
 
-    lint.Run([os.path.dirname(filename)]+pylint_args, reporter=TextReporter(pylint_output), do_exit=False)
-
-    for init_file in init_files:
-        os.remove(init_file)
+    try:
+        lint.Run([os.path.dirname(filename)]+PYLINT_ARGS, reporter=TextReporter(pylint_output), exit=False)
+    finally:
+        for init_file in init_files:
+            os.remove(init_file)
 
     output = list(pylint_output.read())
     if output:
         match = re.match(r'[^\d]+(\-?\d{1,3}\.\d{2}).*', output[-3])
         if not match:
-            return 0
+            return 0, ''.join(output)
         rate = float(match.groups()[0]) * 10
 
         with open(filename) as file:
@@ -56,7 +107,71 @@ def run_pylint(filename, verbose=False):
     else:
         rate = 100.0
 
+    if key is not None:
+        _write_pylint_cache(cache_file, key, {'rating': rate, 'report': ''.join(output)})
+    return rate, ''.join(output)
+
+
+def run_pylint(filename, verbose=False, cache_file=None):
+    """ Run pylint on the given file, the rating is looked up in cache_file if the sources are unchanged """
+    rate, report = check_code_quality(filename, cache_file)
+
     if verbose:
-        print(''.join(pylint_output.read()))
+        print(report)
 
     return rate
+
+
+class BackgroundPylint():
+    """ Run pylint in a background process, e.g. while the model is created """
+    def __init__(self, filename, cache_file=None):
+        self.pool = multiprocessing.Pool(1)
+        self.result = self.pool.apply_async(check_code_quality, (filename, cache_file))
+        self.pool.close()
+
+    def rating(self, verbose=False):
+        """ Wait for pylint and return the rating """
+        rate, report = self.result.get()
+        self.pool.join()
+        if verbose:
+            print(report)
+        return rate
+
+
+def write_prediction(output_dir, prediction):
+    """ Write a prediction to <output_dir>/<file name>.prediction """
+    prediction_file = os.path.join(output_dir, f"{os.path.splitext(prediction['file'])[0]}.prediction")
+    with open(prediction_file, 'w') as file:
+        file.write(json.dumps(prediction))
+
+
+# name of the optional bulk prediction file, JSON Lines with one prediction per line
+BULK_PREDICTIONS = 'predictions.jsonl'
+
+
+class BulkPredictionWriter():
+    """ Write all predictions as one JSON Lines stream with an index file name -> (byte offset, length)
+
+        The stream and the index are written to temporary files and renamed on close, the stream first. The index of
+        a previous run is removed up front, so an interrupted run never leaves an index next to a stream it does not
+        describe and the scoring program falls back to the single prediction files. """
+    def __init__(self, bulk_file):
+        self.bulk_file = bulk_file
+        self.index = {}
+        if os.path.exists(f"{bulk_file}.index"):
+            os.remove(f"{bulk_file}.index")
+        self.file = open(f"{bulk_file}.tmp", 'wb')
+
+    def write(self, prediction):
+        """ Append a prediction """
+        line = (json.dumps(prediction) + '\n').encode('utf-8')
+        self.index[os.path.splitext(prediction['file'])[0]] = (self.file.tell(), len(line))
+        self.file.write(line)
+
+    def close(self):
+        """ Close the stream and write the index to <bulk file>.index """
+        self.file.close()
+        with open(f"{self.bulk_file}.index.tmp", 'w') as index_file:
+            index_file.write(json.dumps(self.index))
+        os.replace(f"{self.bulk_file}.tmp", self.bulk_file)
+        os.replace(f"{self.bulk_file}.index.tmp", f"{self.bulk_file}.index")
@@ -0,0 +1,124 @@
+""" Sharded ingestion across several worker processes """
+
+import os
+import sys
+import glob
+import queue
+import time
+import importlib
+import multiprocessing
+
+# environment variables which limit the threads of the numerical libraries in a worker
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+
+def input_files(directory):
+    """ Sorted paths of the tiff files of a directory, including the packed volumes of the submission's packed dataset
+        (see packed_dataset.py) whose tiff files are missing. The submission dir has to be on the path. """
+    try:
+        packed_dataset = importlib.import_module('packed_dataset')
+    except ImportError:  # submissions without packed datasets
+        return sorted(glob.glob(os.path.join(os.path.abspath(directory), '*.tiff')))
+    return packed_dataset.input_files(directory)
+
+
+def _worker(worker_id, submission_dir, files, cpus, cache, messages):
+    """ Predict a shard of the tiff files with an own model instance and stream the predictions back """
+    # limit the threads before torch & co. are imported and pin the worker to its share of the cores
+    os.environ.update({name: str(len(cpus)) for name in THREAD_VARIABLES})
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    sys.path.append(submission_dir)
+    tic = time.time()
+    from model import Model
+    startup = {'imports': time.time() - tic}
+
+    tic = time.time()
+    model = Model()
+    startup['model'] = time.time() - tic
+    startup.update(getattr(model, 'startup', {}))
+    if not hasattr(model, 'predict_files'):
+        raise TypeError('Sharded ingestion requires a model with a predict_files method')
+    if cache is not None and hasattr(model, 'use_cache'):
+        model.use_cache(*cache)
+
+    start = time.time()
+    count = 0
+    for prediction in model.predict_files(files):
+        messages.put(('prediction', prediction))
+        count += 1
+    end = time.time()
+
+    stats = {'files': count, 'start': start, 'end': end, 'startup': startup}
+    if getattr(model, 'cache', None) is not None:
+        stats['prediction_cache'] = model.cache.stats()
+    if getattr(model, 'timer', None) is not None:
+        stats['stages'] = model.timer.summary()
+    messages.put(('done', worker_id, stats))
+
+
+class ShardedIngestion:
+    """ Split the tiff files into shards which are predicted by worker processes """
+
+    def __init__(self, submission_dir, files, workers, cache=None):
+        """
+        :param submission_dir: directory of the submitted model
+        :param files: paths of the tiff files
+        :param workers: number of worker processes
+        :param cache: arguments of Model.use_cache (path, max_entries) or None
+        """
+        self.submission_dir = submission_dir
+        self.shards = [files[i::workers] for i in range(workers)]  # interleaved shards balance the load
+        self.cache = cache
+        self.worker_stats = {}
+
+    def predictions(self):
+        """ Start the workers and yield the predictions in the order they arrive """
+        context = multiprocessing.get_context('spawn')
+        messages = context.Queue()
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        processes = []
+        for worker_id, shard in enumerate(self.shards):
+            worker_cpus = cpus[worker_id::len(self.shards)] or cpus
+            process = context.Process(target=_worker, daemon=True,
+                                      args=(worker_id, self.submission_dir, shard, worker_cpus, self.cache, messages))
+            process.start()
+            processes.append(process)
+
+        while len(self.worker_stats) < len(processes):
+            try:
+                message = messages.get(timeout=1)
+            except queue.Empty:
+                for worker_id, process in enumerate(processes):
+                    if worker_id not in self.worker_stats and process.exitcode not in (None, 0):
+                        raise RuntimeError(f"Worker {worker_id} failed with exit code {process.exitcode}")
+                continue
+
+            if message[0] == 'prediction':
+                yield message[1]
+            else:
+                self.worker_stats[message[1]] = message[2]
+
+        for process in processes:
+            process.join()
+
+    def metrics(self):
+        """ Merged prediction time, per worker throughput and merged cache counters of the finished workers """
+        stats = [self.worker_stats[worker_id] for worker_id in sorted(self.worker_stats)]
+        metrics = {
+            # wall clock time from the first worker starting to predict until the last one finished
+            'prediction_time': max(s['end'] for s in stats) - min(s['start'] for s in stats),
+            'workers': [{
+                'files': s['files'],
+                'prediction_time': s['end'] - s['start'],
+                'images_per_second': s['files'] / (s['end'] - s['start']) if s['end'] > s['start'] else 0,
+                'startup': s['startup'],
+                **({'stages': s['stages']} if 'stages' in s else {}),
+            } for s in stats],
+        }
+        caches = [s['prediction_cache'] for s in stats if 'prediction_cache' in s]
+        if caches:
+            metrics['prediction_cache'] = {key: sum(cache[key] for cache in caches) for key in ('hits', 'misses')}
+            metrics['prediction_cache']['entries'] = max(cache['entries'] for cache in caches)
+        return metrics
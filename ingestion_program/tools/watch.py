@@ -0,0 +1,188 @@
+""" Continuous ingestion of the tiff files which scanners drop into a watched directory """
+
+import os
+import json
+import time
+from collections import deque
+import cv2
+
+# file of the processed tiff files in the output directory, one json line per file
+CHECKPOINT_FILE = 'watch_checkpoint.jsonl'
+# file of the live metrics in the output directory, rewritten after every batch
+METRICS_FILE = 'watch_metrics.json'
+# errors of the model on a corrupt or unreadable tiff file, which are recorded in the checkpoint instead of ending the
+# watch: the file cannot be read (OSError), decoded (ValueError of the tiff reader, cv2.error of the preprocessing) or
+# inferred (RuntimeError, also raised by a thin client for the error response of the inference server)
+PREDICTION_ERRORS = (OSError, ValueError, cv2.error, RuntimeError)
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of a non-empty list """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FolderWatcher:
+    """ Poll a directory for completed tiff files which have not been processed before """
+
+    def __init__(self, directory, checkpoint_file, settle_time=1.0):
+        """
+        :param directory: watched directory
+        :param checkpoint_file: json lines file of the processed files, which is appended to and survives restarts
+        :param settle_time: seconds during which the size and modification time of a new file must not change before
+                            it is considered complete, scanners may still be writing it before
+        """
+        self.directory = directory
+        self.checkpoint_file = checkpoint_file
+        self.settle_time = settle_time
+        self.processed = {}  # file name -> [size, mtime_ns] when it was processed
+        self.pending = {}  # file name -> ([size, mtime_ns], time when this state was first seen)
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.processed[entry['file']] = entry['source']
+
+    def poll(self):
+        """ Paths and arrival times (modification time in seconds) of the files which have been completed since the
+            last poll, oldest first """
+        now = time.time()
+        completed = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.tiff') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                source = [stat.st_size, stat.st_mtime_ns]
+                if self.processed.get(entry.name) == source:
+                    continue
+                if self.pending.get(entry.name, (None,))[0] != source:
+                    self.pending[entry.name] = (source, now)  # new or still being written
+                elif now - self.pending[entry.name][1] >= self.settle_time:
+                    completed.append((stat.st_mtime_ns / 1e9, entry.path))
+                    del self.pending[entry.name]
+        return [(file_path, arrival) for arrival, file_path in sorted(completed)]
+
+    def backlog(self):
+        """ Number of new files which are not complete yet """
+        return len(self.pending)
+
+    def mark_processed(self, file_paths, errors=None):
+        """ Record the files in the checkpoint, such that they are not processed again after a restart unless they
+            change. Files which have been removed meanwhile are not recorded.
+            :param errors: dictionary file path -> error message of the files which could not be predicted """
+        lines = []
+        for file_path in file_paths:
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            name = os.path.basename(file_path)
+            self.processed[name] = [stat.st_size, stat.st_mtime_ns]
+            entry = {'file': name, 'source': self.processed[name]}
+            if errors and file_path in errors:
+                entry['error'] = errors[file_path]
+            lines.append(json.dumps(entry) + '\n')
+        with open(self.checkpoint_file, 'a', encoding='utf-8') as file:
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class LatencyMonitor:
+    """ Arrival to prediction latency of the watched files over a sliding window """
+
+    def __init__(self, metrics_file, window=1000):
+        """
+        :param metrics_file: json file which is rewritten with the live metrics
+        :param window: number of most recent files the percentiles are computed over
+        """
+        self.metrics_file = metrics_file
+        self.latencies = deque(maxlen=window)
+        self.files = 0
+        self.failures = 0  # files which could not be predicted
+        self.start = time.time()
+
+    def record(self, arrival):
+        """ Record the latency of a file whose prediction has just been written """
+        self.latencies.append(time.time() - arrival)
+        self.files += 1
+
+    def record_failure(self):
+        """ Record a file which could not be predicted """
+        self.failures += 1
+
+    def summary(self):
+        """ Processed and failed files, throughput and latency percentiles in seconds """
+        summary = {'files': self.files, 'failed_files': self.failures,
+                   'files_per_second': self.files / max(time.time() - self.start, 1e-9)}
+        if self.latencies:
+            summary.update({f'latency_p{q:d}': percentile(self.latencies, q / 100) for q in (50, 95, 99)})
+            summary['latency_max'] = max(self.latencies)
+        return summary
+
+    def publish(self, backlog):
+        """ Print the live metrics and atomically rewrite the metrics file """
+        summary = {**self.summary(), 'backlog': backlog, 'time': time.time()}
+        with open(f"{self.metrics_file}.tmp", 'w', encoding='utf-8') as file:
+            file.write(json.dumps(summary))
+        os.replace(f"{self.metrics_file}.tmp", self.metrics_file)
+        if self.latencies:
+            print(f"{summary['files']:d} files, {summary['failed_files']:d} failed, "
+                  f"latency p50 {summary['latency_p50']:.3g} s, p95 {summary['latency_p95']:.3g} s, "
+                  f"p99 {summary['latency_p99']:.3g} s, "
+                  f"{backlog:d} files still being written")
+        return summary
+
+
+def predict_batch(model, file_paths):
+    """ Predict a batch of files. If the batch fails, e.g. on a corrupt tiff file, its files are predicted one by one
+        such that only the failing files are lost.
+        :return: list with the prediction or the exception of every file """
+    try:
+        return list(model.predict_files(file_paths))
+    except PREDICTION_ERRORS:
+        pass
+    results = []
+    for file_path in file_paths:
+        try:
+            results.extend(model.predict_files([file_path]))
+        except PREDICTION_ERRORS as error:
+            results.append(error)
+    return results
+
+
+def watch(model, watcher, monitor, write_prediction, options):
+    """ Predict the completed files of the watched directory in small batches until the idle timeout expires
+        :param options: dictionary with batch_size, poll_interval and idle_timeout (seconds without new files after
+                        which the watch ends, None to watch until interrupted)
+        :return: the seconds spent inside the model """
+    prediction_time = 0
+    idle_since = time.time()
+    try:
+        while options['idle_timeout'] is None or time.time() - idle_since < options['idle_timeout']:
+            ready = watcher.poll()
+            if not ready:
+                time.sleep(options['poll_interval'])
+                continue
+            for start in range(0, len(ready), options['batch_size']):
+                batch = ready[start:start + options['batch_size']]
+                tic = time.time()
+                results = predict_batch(model, [file_path for file_path, _ in batch])
+                prediction_time += time.time() - tic
+                errors = {}
+                for result, (file_path, arrival) in zip(results, batch):
+                    if isinstance(result, Exception):
+                        errors[file_path] = f"{type(result).__name__}: {result}"
+                        print(f"Could not predict {file_path}: {errors[file_path]}")
+                        monitor.record_failure()
+                    else:
+                        write_prediction(result)
+                        monitor.record(arrival)
+                watcher.mark_processed([file_path for file_path, _ in batch], errors)
+                monitor.publish(watcher.backlog())
+            idle_since = time.time()
+    except KeyboardInterrupt:
+        print('Watch interrupted')
+    return prediction_time
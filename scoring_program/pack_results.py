@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+"""
+Pack single result files into one bulk JSON Lines file with an index by file name, e.g. the labels for score.py:
+
+python pack_results.py ../evaluation_results/ref_cust .json labels.jsonl
+"""
+
+import os
+from sys import argv
+import tools.helpers
+
+if __name__ == "__main__":
+    if len(argv) != 4:
+        raise SystemExit(f"Usage: python {os.path.basename(argv[0])} directory extension bulk_name")
+    DIRECTORY, EXTENSION, BULK_NAME = argv[1:]
+
+    result_files = tools.helpers.list_files(os.path.join(DIRECTORY, '*' + EXTENSION))
+    tools.helpers.write_bulk_results(
+        os.path.join(DIRECTORY, BULK_NAME),
+        ((os.path.splitext(os.path.basename(f))[0], tools.helpers.load_results(f)) for f in result_files))
+    print(f"Packed {len(result_files):d} files into {os.path.join(DIRECTORY, BULK_NAME)}")
@@ -7,20 +7,31 @@ This code computes several metrics based on the predictions exported by the inge
 """
 
 import os
-from sys import argv
+import argparse
 import json
 import yaml
-import tools.metrics
 import tools.helpers
+import tools.incremental
 
 # Default I/O directories:
 ROOT_DIR = ".."
 DEFAULT_INPUT_DIR = os.path.join(ROOT_DIR, "evaluation_results")
 DEFAULT_OUTPUT_DIR = os.path.join(ROOT_DIR, "scoring_output")
 
+# Incremental scoring: path of a cache of the per-sample intermediates of the metrics, keyed by the content of the
+# label and the prediction. Only samples whose label or prediction changed are evaluated again. None disables the cache.
+# Can be overridden with --cache PATH.
+SCORE_CACHE = None
+
 if __name__ == "__main__":
     print('\nScoring program started')
 
+    parser = argparse.ArgumentParser(description='Scoring program')
+    parser.add_argument('dirs', nargs='*', metavar='dir', help='input_dir output_dir')
+    parser.add_argument('--cache', default=SCORE_CACHE, help='cache of the per-sample intermediates of the metrics')
+    args = parser.parse_args()
+    argv = [parser.prog] + args.dirs
+
     if len(argv) == 1:  # Use the default input and output directories if no arguments are provided
         INPUT_DIR = DEFAULT_INPUT_DIR
         OUTPUT_DIR = DEFAULT_OUTPUT_DIR
@@ -32,18 +43,14 @@ if __name__ == "__main__":
     if not os.path.exists(OUTPUT_DIR):
         os.mkdir(OUTPUT_DIR)
 
-    files = []
-    for (dirpath, dirnames, filenames) in os.walk(INPUT_DIR):
-        files.extend(map(lambda n: os.path.join(*n), zip([dirpath] * len(filenames), filenames)))
-
     score_file_path = os.path.join(OUTPUT_DIR, 'scores.txt')
     ingestion_score_file_path = os.path.join(INPUT_DIR, 'res', 'ingestion_metrics.json')
     html_file_path = os.path.join(OUTPUT_DIR, 'scores.html')
 
-    # Get all the solution files from the solution directory
-    solution_names = tools.helpers.list_files(os.path.join(INPUT_DIR, 'ref_cust', '*.json'))
+    # Get all the solutions, from ref_cust/labels.jsonl if present, otherwise from the single json files
+    labels = tools.helpers.load_named_raw(os.path.join(INPUT_DIR, 'ref_cust'), '.json', tools.helpers.BULK_LABELS)
 
-    if len(solution_names) == 0:
+    if len(labels) == 0:
         raise FileNotFoundError("No solution files found.")
 
     score = {
@@ -65,25 +72,24 @@ if __name__ == "__main__":
         except Exception as e:
             print('Error:', e)
 
-    solutions = []
-    predictions = []
-
-    for i, solution_file in enumerate(solution_names):
-        # Get the last prediction from the res subdirectory (must end with '.predict')
-        predict_file = os.path.join(
-            INPUT_DIR, 'res', f"{os.path.splitext(os.path.basename(solution_file))[0]}.prediction")
-        if not os.path.exists(predict_file):
-            raise IOError('Missing prediction file {}'.format(predict_file))
-        # Read the solution and prediction values into numpy arrays
-        solutions.append(tools.helpers.load_results(solution_file))
-        predictions.append(tools.helpers.load_results(predict_file))
-
-    print(f"Scoring is based on {len(predictions):d} samples.")
-
-    # Compute scoring metrics
-    score['anomaly_detection_accuracy']['val'] = tools.metrics.anomaly_detection_accuracy(solutions, predictions)
-    score['avg_sample_accuracy']['val'] = tools.metrics.avg_sample_accuracy(solutions, predictions)
-    score['distance']['val'] = tools.metrics.distance(solutions, predictions)
+    # Get the predictions from res/predictions.jsonl if present, otherwise from the single .prediction files
+    names = sorted(labels)
+    results = tools.helpers.load_named_raw(
+        os.path.join(INPUT_DIR, 'res'), '.prediction', tools.helpers.BULK_PREDICTIONS, names=names)
+    missing = sorted(set(labels) - set(results))
+    if missing:
+        raise IOError('Missing predictions for {}'.format(', '.join(missing)))
+
+    print(f"Scoring is based on {len(names):d} samples.")
+
+    # Compute scoring metrics, only the samples which are not cached are evaluated
+    cache = tools.incremental.SampleCache(args.cache) if args.cache else None
+    samples = tools.incremental.evaluate_samples(labels, results, names, cache)
+    if cache is not None:
+        print(f"Evaluated {cache.misses:d} changed samples, {cache.hits:d} samples were cached.")
+        cache.close()
+    for metric, value in tools.incremental.metrics(samples).items():
+        score[metric]['val'] = value
 
     if os.path.exists(ingestion_score_file_path):
         with open(ingestion_score_file_path, 'r') as ingestion_score_file:
@@ -0,0 +1,219 @@
+"""
+Columnar, vectorized implementation of the metrics in tools.metrics.
+
+Labels and predictions are loaded once into NumPy arrays: one count per sample and pill type, plus all coordinates of a
+pill type concatenated into one array with an offset index per sample. The count based metrics are vectorized
+reductions and the Hungarian matching of the distance metric is spread across a process pool. All results are
+identical to the ones of tools.metrics. Every metric is split into per-sample intermediates and their aggregation, such
+that the intermediates can be cached (see tools.incremental).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.spatial.distance import cdist
+from scipy.optimize import linear_sum_assignment
+
+PILL_TYPES = ('present', 'missing')
+CHUNK_SIZE = 4096  # samples per task of the process pool
+MIN_PARALLEL_SAMPLES = 2 * CHUNK_SIZE  # below this the matching runs in the calling process
+
+
+class ColumnarResults:
+    """ Counts and coordinates of many labels or predictions in contiguous arrays """
+
+    def __init__(self, results):
+        """
+        :param results: iterable of label or prediction dictionaries
+        """
+        counts = {'missing_pills': [], 'present_pills': []}
+        coordinates = {pill_type: [] for pill_type in PILL_TYPES}
+        lengths = {pill_type: [] for pill_type in PILL_TYPES}
+        for result in results:
+            for key, values in counts.items():
+                values.append(result[key])
+            for pill_type in PILL_TYPES:
+                coordinates[pill_type].extend(result['coordinates'][pill_type])
+                lengths[pill_type].append(len(result['coordinates'][pill_type]))
+
+        self.missing_pills = np.array(counts['missing_pills'], dtype=np.int64)
+        self.present_pills = np.array(counts['present_pills'], dtype=np.int64)
+        self.coordinates = {pill_type: np.array(coordinates[pill_type], dtype=np.float64).reshape(-1, 2)
+                            for pill_type in PILL_TYPES}
+        self.offsets = {pill_type: np.concatenate(([0], np.cumsum(lengths[pill_type], dtype=np.int64)))
+                        for pill_type in PILL_TYPES}
+
+    def __len__(self):
+        return len(self.missing_pills)
+
+    def lengths(self, pill_type):
+        """ Number of coordinates of every sample """
+        return np.diff(self.offsets[pill_type])
+
+
+# anomaly detection outcome of a sample, see anomaly_buckets
+TRUE_POSITIVE, TRUE_NEGATIVE, FALSE_NEGATIVE, FALSE_POSITIVE = range(4)
+
+
+def anomaly_buckets(labels, predictions):
+    """ Anomaly detection outcome of every sample, -1 for samples in none of the buckets """
+
+    label_anomaly = labels.missing_pills > 0
+    predicted_anomaly = predictions.missing_pills > 0
+    label_normal = labels.missing_pills == 0
+    predicted_normal = predictions.missing_pills == 0
+
+    buckets = np.full(len(labels), -1, dtype=np.int8)
+    buckets[label_anomaly & predicted_anomaly] = TRUE_POSITIVE
+    buckets[label_normal & predicted_normal] = TRUE_NEGATIVE
+    buckets[label_anomaly & predicted_normal] = FALSE_NEGATIVE
+    buckets[label_normal & predicted_anomaly] = FALSE_POSITIVE
+    return buckets
+
+
+def bucket_accuracy(buckets):
+    """ Sample accuracy metric from the anomaly detection outcomes """
+
+    true_positives, true_negatives, false_negatives, false_positives = \
+        (int(np.count_nonzero(buckets == bucket)) for bucket in range(4))
+
+    sample_accuracy = (true_positives + true_negatives) \
+        / (true_positives + true_negatives + false_positives + false_negatives)
+
+    return 100 * sample_accuracy
+
+
+def anomaly_detection_accuracy(labels, predictions):
+    """ Sample accuracy metric """
+
+    return bucket_accuracy(anomaly_buckets(labels, predictions))
+
+
+def accuracy(labels, predictions):
+    """ Accuracy metric """
+
+    correct = (labels.present_pills == predictions.present_pills) & (labels.missing_pills == predictions.missing_pills)
+
+    return 100 * (int(np.count_nonzero(correct)) / len(labels))
+
+
+def slot_count_accuracy(labels, predictions):
+    """ Slot count accuracy """
+
+    label_slots = int(np.sum(labels.missing_pills + labels.present_pills))
+    predicted_slots = int(np.sum(predictions.missing_pills + predictions.present_pills))
+
+    return 100 * (1 - abs(label_slots - predicted_slots) / label_slots)
+
+
+def slot_count_accuracy2(labels, predictions):
+    """ Slot count accuracy 2 """
+
+    predicted_slots = int(np.sum(predictions.present_pills)) + int(np.sum(predictions.missing_pills))
+    label_slots = int(np.sum(labels.present_pills)) + int(np.sum(labels.missing_pills))
+
+    return 100 * (predicted_slots / label_slots)
+
+
+def sample_deviation(labels, predictions):
+    """ Fraction of wrongly detected slots of every sample """
+
+    total_number_of_slots = labels.missing_pills + labels.present_pills
+    return (np.abs(labels.missing_pills - predictions.missing_pills)
+            + np.abs(labels.present_pills - predictions.present_pills)) / total_number_of_slots
+
+
+def deviation_accuracy(deviation):
+    """ Average sample accuracy from the per-sample deviations """
+
+    return 100 * (1 - np.mean(deviation))
+
+
+def avg_sample_accuracy(labels, predictions):
+    """ Average sample accuracy """
+
+    return deviation_accuracy(sample_deviation(labels, predictions))
+
+
+def _weighting(input_val, mu=0, sigma=10):
+    """ Convert Euclidean distance to score using Gaussian weighting """
+
+    return np.exp(-(input_val - mu) ** 2 / (2 * sigma ** 2))
+
+
+def gaussian_scores(points_ref, offsets_ref, points, offsets):
+    """
+    Gaussian distance score of every sample of a chunk, 0 where the label or the prediction has no points
+    :param points_ref: concatenated label coordinates of the chunk
+    :param offsets_ref: offsets of the label coordinates of every sample, relative to points_ref
+    :param points: concatenated predicted coordinates of the chunk
+    :param offsets: offsets of the predicted coordinates of every sample, relative to points
+    :return: array with one score per sample
+    """
+    scores = np.zeros(len(offsets_ref) - 1)
+    for index in range(len(scores)):
+        sample_ref = points_ref[offsets_ref[index]:offsets_ref[index + 1]]
+        sample = points[offsets[index]:offsets[index + 1]]
+        if len(sample_ref) > 0 and len(sample) > 0:
+            cost_matrix = cdist(sample_ref, sample)  # Euclidean norm
+            row_assignment, col_assignment = linear_sum_assignment(cost_matrix)
+            scores[index] = np.mean(_weighting(cost_matrix[row_assignment, col_assignment]))
+    return scores
+
+
+def _chunks(labels, predictions, pill_type, chunk_size):
+    """ Arguments of gaussian_scores for consecutive chunks of samples """
+
+    for start in range(0, len(labels), chunk_size):
+        stop = min(start + chunk_size, len(labels))
+        chunk = []
+        for results in (labels, predictions):
+            offsets = results.offsets[pill_type][start:stop + 1]
+            chunk += [results.coordinates[pill_type][offsets[0]:offsets[-1]], offsets - offsets[0]]
+        yield chunk
+
+
+def distance_scores(labels, predictions, workers=None):
+    """
+    Gaussian distance score and number of matched label pills of every sample
+    :param labels: ColumnarResults of the labels
+    :param predictions: ColumnarResults of the predictions
+    :param workers: number of processes for the matching (default: number of CPUs, 1 disables the pool)
+    :return: dictionaries pill type -> scores array and pill type -> pill count array
+    """
+
+    workers = workers or os.cpu_count()
+    scores = {}
+    pills = {}
+    for pill_type in PILL_TYPES:
+        chunks = list(_chunks(labels, predictions, pill_type, CHUNK_SIZE))
+        if workers > 1 and len(labels) >= MIN_PARALLEL_SAMPLES:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunk_scores = list(executor.map(gaussian_scores, *zip(*chunks)))
+        else:
+            chunk_scores = [gaussian_scores(*chunk) for chunk in chunks]
+        scores[pill_type] = np.concatenate(chunk_scores) if chunk_scores else np.zeros(0)
+
+        matched = (labels.lengths(pill_type) > 0) & (predictions.lengths(pill_type) > 0)
+        pills[pill_type] = np.where(matched, labels.lengths(pill_type), 0)
+    return scores, pills
+
+
+def distance_rating(scores, pills):
+    """ Rating for Euclidean distance from the per-sample scores and pill counts of distance_scores """
+
+    number_of_pills = {pill_type: int(np.sum(pills[pill_type])) for pill_type in PILL_TYPES}
+    total_number_of_pills = number_of_pills['present'] + number_of_pills['missing']
+    return 100 * (np.mean(scores['present']) * number_of_pills['present']
+                  + np.mean(scores['missing']) * number_of_pills['missing']) / total_number_of_pills
+
+
+def distance(labels, predictions, workers=None):
+    """
+    Compute rating for Euclidean distance
+    :param labels: ColumnarResults of the labels
+    :param predictions: ColumnarResults of the predictions
+    :param workers: number of processes for the matching (default: number of CPUs, 1 disables the pool)
+    """
+
+    return distance_rating(*distance_scores(labels, predictions, workers))
@@ -1,3 +1,4 @@
+import os
 from glob import glob
 import json
 
@@ -12,3 +13,67 @@ def load_results(results_file):
 
     with open(results_file, 'r') as file_obj:
         return json.load(file_obj)
+
+
+# names of the optional bulk files, JSON Lines with one result per line and an index file <bulk file>.index
+BULK_LABELS = 'labels.jsonl'
+BULK_PREDICTIONS = 'predictions.jsonl'
+
+
+def load_bulk_raw(bulk_file):
+    """ Read all results of a bulk file in one pass as encoded JSON, keyed by file name without extension """
+
+    with open(bulk_file, 'rb') as file_obj:
+        data = file_obj.read()
+    with open(f"{bulk_file}.index", 'r') as index_file:
+        index = json.load(index_file)
+
+    return {name: data[offset:offset + length] for name, (offset, length) in index.items()}
+
+
+def load_bulk_results(bulk_file):
+    """ Load all results of a bulk file in one pass, keyed by file name without extension """
+
+    return {name: json.loads(raw) for name, raw in load_bulk_raw(bulk_file).items()}
+
+
+def write_bulk_results(bulk_file, results):
+    """ Write results given as (name, result) pairs into a bulk file and its index, both are renamed into place """
+
+    if os.path.exists(f"{bulk_file}.index"):
+        os.remove(f"{bulk_file}.index")
+    index = {}
+    with open(f"{bulk_file}.tmp", 'wb') as file_obj:
+        for name, result in results:
+            line = (json.dumps(result) + '\n').encode('utf-8')
+            index[name] = (file_obj.tell(), len(line))
+            file_obj.write(line)
+    with open(f"{bulk_file}.index.tmp", 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(f"{bulk_file}.tmp", bulk_file)
+    os.replace(f"{bulk_file}.index.tmp", f"{bulk_file}.index")
+
+
+def load_named_raw(directory, extension, bulk_name, names=None):
+    """ Read encoded results keyed by file name without extension, from the bulk file if present, else single files """
+
+    bulk_file = os.path.join(directory, bulk_name)
+    if os.path.exists(bulk_file) and os.path.exists(f"{bulk_file}.index"):  # no index: interrupted bulk write
+        return load_bulk_raw(bulk_file)
+
+    if names is None:
+        names = [os.path.splitext(os.path.basename(f))[0] for f in list_files(os.path.join(directory, '*' + extension))]
+    results = {}
+    for name in names:
+        results_file = os.path.join(directory, name + extension)
+        if not os.path.exists(results_file):
+            raise IOError('Missing results file {}'.format(results_file))
+        with open(results_file, 'rb') as file_obj:
+            results[name] = file_obj.read()
+    return results
+
+
+def load_named_results(directory, extension, bulk_name, names=None):
+    """ Load results keyed by file name without extension, from the bulk file if present, else from single files """
+
+    return {name: json.loads(raw) for name, raw in load_named_raw(directory, extension, bulk_name, names).items()}
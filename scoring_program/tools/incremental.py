@@ -0,0 +1,122 @@
+"""
+Incremental scoring: the per-sample intermediates of the metrics are cached, keyed by the content of the label and the
+prediction, such that a rescoring only evaluates the samples whose label or prediction changed.
+"""
+
+import json
+import sqlite3
+import hashlib
+import numpy as np
+import tools.columnar
+
+# per-sample intermediates of the metrics, see tools.columnar
+SAMPLE_DTYPE = np.dtype([('bucket', np.int8), ('deviation', np.float64),
+                         ('present_score', np.float64), ('missing_score', np.float64),
+                         ('present_pills', np.int64), ('missing_pills', np.int64)])
+VERSION = b'1'  # change when the intermediates are computed differently, invalidates all cached samples
+QUERY_SIZE = 500  # keys per SELECT, below the SQLite variable limit
+
+
+class SampleCache:
+    """ SQLite backed cache of the per-sample intermediates """
+
+    def __init__(self, path):
+        """
+        :param path: path of the SQLite database
+        """
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(str(path))
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS samples (key TEXT PRIMARY KEY, sample BLOB NOT NULL)')
+        self._connection.commit()
+
+    @staticmethod
+    def key(label, prediction):
+        """ Cache key of the encoded label and prediction of a sample """
+
+        digest = hashlib.sha256(VERSION)
+        digest.update(hashlib.sha256(label).digest())
+        digest.update(hashlib.sha256(prediction).digest())
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        """ Look up samples, returns a dictionary key -> encoded sample of the cached ones """
+
+        cached = {}
+        for start in range(0, len(keys), QUERY_SIZE):
+            chunk = keys[start:start + QUERY_SIZE]
+            cached.update(self._connection.execute(
+                f"SELECT key, sample FROM samples WHERE key IN ({', '.join('?' * len(chunk))})", chunk).fetchall())
+        hits = sum(key in cached for key in keys)  # samples with identical content share a key
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return cached
+
+    def put_many(self, keys, samples):
+        """ Store samples given as array of SAMPLE_DTYPE """
+
+        self._connection.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?)',
+                                     [(key, sample.tobytes()) for key, sample in zip(keys, samples)])
+        self._connection.commit()
+
+    def close(self):
+        """ Close the database """
+
+        self._connection.close()
+
+
+def compute_samples(labels, predictions, workers=None):
+    """ Per-sample intermediates of ColumnarResults of labels and predictions """
+
+    samples = np.zeros(len(labels), dtype=SAMPLE_DTYPE)
+    samples['bucket'] = tools.columnar.anomaly_buckets(labels, predictions)
+    samples['deviation'] = tools.columnar.sample_deviation(labels, predictions)
+    scores, pills = tools.columnar.distance_scores(labels, predictions, workers)
+    for pill_type in tools.columnar.PILL_TYPES:
+        samples[f'{pill_type}_score'] = scores[pill_type]
+        samples[f'{pill_type}_pills'] = pills[pill_type]
+    return samples
+
+
+def evaluate_samples(labels, predictions, names, cache=None, workers=None):
+    """
+    Per-sample intermediates of all samples, only the ones missing in the cache are evaluated
+    :param labels: dictionary name -> encoded label
+    :param predictions: dictionary name -> encoded prediction
+    :param names: names of the samples in the order of the result
+    :param cache: SampleCache or None to evaluate all samples
+    :param workers: number of processes for the distance matching, see tools.columnar.distance
+    :return: array of SAMPLE_DTYPE with one entry per name
+    """
+    keys = [SampleCache.key(labels[name], predictions[name]) for name in names]
+    cached = cache.get_many(keys) if cache is not None else {}
+    stale = [index for index, key in enumerate(keys) if key not in cached]
+    fresh = [index for index, key in enumerate(keys) if key in cached]
+
+    samples = np.zeros(len(names), dtype=SAMPLE_DTYPE)
+    if fresh:
+        samples[fresh] = np.frombuffer(b''.join(cached[keys[index]] for index in fresh), dtype=SAMPLE_DTYPE)
+    if stale:
+        computed = compute_samples(tools.columnar.ColumnarResults(json.loads(labels[names[i]]) for i in stale),
+                                   tools.columnar.ColumnarResults(json.loads(predictions[names[i]]) for i in stale),
+                                   workers)
+        samples[stale] = computed
+        if cache is not None:
+            cache.put_many([keys[index] for index in stale], computed)
+    return samples
+
+
+def metrics(samples):
+    """ Aggregate the per-sample intermediates into the anomaly detection, average sample and distance metrics """
+
+    def column(field):
+        return np.ascontiguousarray(samples[field])  # same summation order as the columnar metrics
+
+    pill_types = tools.columnar.PILL_TYPES
+    return {
+        'anomaly_detection_accuracy': tools.columnar.bucket_accuracy(column('bucket')),
+        'avg_sample_accuracy': tools.columnar.deviation_accuracy(column('deviation')),
+        'distance': tools.columnar.distance_rating({pill_type: column(f'{pill_type}_score') for pill_type in pill_types},
+                                                   {pill_type: column(f'{pill_type}_pills') for pill_type in pill_types}),
+    }
@@ -0,0 +1,81 @@
+"""
+Tiled inference on a synthetic scene larger than a tile, with a detector which reports a known lattice of pills.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('torchvision')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code_submission'))
+
+from detect_single import DETECTION_DTYPE
+from instrumentation import StageTimer
+from tiling import TiledDetector
+
+SCENE_SHAPE = (700, 1100, 3)
+PILL_SIZE = (30, 20)  # width and height
+
+
+def lattice(seed=0):
+    """
+    Classes and centers (x, y from the top) of the pills of the scene
+    """
+    rng = np.random.default_rng(seed)
+    centers = [(x, y) for x in np.arange(20, SCENE_SHAPE[1] - 20, 37.0)
+               for y in np.arange(15, SCENE_SHAPE[0] - 15, 29.0)]
+    return [(int(rng.integers(0, 2)), x, y) for x, y in centers]
+
+
+class LatticeDetector:
+    """
+    Detector which reports the part of every lattice pill that is visible in a tile, like a detector on a cut pill.
+    The tiles of the scene carry their origin in the first two channels.
+    """
+
+    def __init__(self, pills):
+        self.pills = pills
+        self.timer = StageTimer()
+        self.rng = np.random.default_rng(1)
+
+    def detect_volumes(self, tiles, batch_size, conf_thres, iou_thres):
+        """
+        Structured arrays of the visible pills of every tile, y measured from the bottom of the tile
+        """
+        del batch_size, conf_thres, iou_thres
+        detections = []
+        for tile in tiles:
+            top, left = int(tile[0, 0, 0]), int(tile[0, 0, 1])
+            height, width = tile.shape[:2]
+            rows = []
+            for cls, x, y in self.pills:
+                x1, y1 = max(x - PILL_SIZE[0] / 2 - left, 0), max(y - PILL_SIZE[1] / 2 - top, 0)
+                x2, y2 = min(x + PILL_SIZE[0] / 2 - left, width), min(y + PILL_SIZE[1] / 2 - top, height)
+                if x2 - x1 > 3 and y2 - y1 > 3:
+                    rows.append((cls, (x1 + x2) / 2, height - (y1 + y2) / 2, x2 - x1, y2 - y1,
+                                 self.rng.uniform(0.7, 1.0)))
+            detections.append(np.array(rows, dtype=DETECTION_DTYPE))
+        return detections
+
+
+def test_tiled_scene_matches_lattice():
+    """
+    Every pill is reported once, at its position in the full frame
+    """
+    pills = lattice()
+    scene = np.zeros(SCENE_SHAPE, dtype=np.float32)
+    scene[..., 0] = np.arange(SCENE_SHAPE[0])[:, None]  # the origin of a tile is its first pixel
+    scene[..., 1] = np.arange(SCENE_SHAPE[1])[None, :]
+    tiler = TiledDetector(LatticeDetector(pills))
+    assert len(tiler.tiles(SCENE_SHAPE)) > 1
+
+    detected = tiler.detect(scene, batch_size=4)
+
+    assert len(detected) == len(pills)
+    expected = sorted((cls, x, SCENE_SHAPE[0] - y) for cls, x, y in pills)
+    found = sorted(zip(detected['cls'].tolist(), detected['x'].tolist(), detected['y'].tolist()))
+    assert [cls for cls, *_ in found] == [cls for cls, *_ in expected]
+    np.testing.assert_allclose([xy for _, *xy in found], [xy for _, *xy in expected], atol=1e-6)
+    np.testing.assert_allclose(detected['w'], PILL_SIZE[0])
+    np.testing.assert_allclose(detected['h'], PILL_SIZE[1])